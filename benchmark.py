@@ -0,0 +1,300 @@
+'''
+Offline benchmarks for the calendar and rendering code.
+
+Usage: python benchmark.py [name ...]
+Runs every benchmark when no name is given. Nothing here talks to google or
+telegram.
+'''
+import sys
+import time
+from datetime import datetime, timedelta, timezone
+
+tz = timezone(timedelta(hours=8))
+
+
+def synthetic_events(n: int, start: datetime = None) -> list:
+    '''n raw calendar api events spread over a working week.'''
+    if start is None:
+        start = datetime(2022, 5, 2, tzinfo=tz)
+    events = []
+    for i in range(n):
+        day = i % 5
+        hour = 7 + (i // 5) % 11
+        s = start + timedelta(days=day, hours=hour, minutes=(i * 15) % 60)
+        e = s + timedelta(minutes=45)
+        events.append({
+            'id': f'e{i}',
+            'summary': f'CPT TAN {i} 41',
+            'start': {'dateTime': s.isoformat(), 'timeZone': 'Asia/Singapore'},
+            'end': {'dateTime': e.isoformat(), 'timeZone': 'Asia/Singapore'},
+            'updated': '2022-05-01T00:00:00.000Z',
+        })
+    return events
+
+
+def bench_event_parsing(n: int = 1000) -> None:
+    import dateparser
+    from event_store import EventRecord
+    events = synthetic_events(n)
+
+    # first dateparser call loads its language data, keep it out of the timing
+    dateparser.parse(events[0]['start']['dateTime'])
+    t0 = time.perf_counter()
+    for e in events:
+        dateparser.parse(e['start']['dateTime']).astimezone(tz)
+        dateparser.parse(e['end']['dateTime']).astimezone(tz)
+    before = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    for i, e in enumerate(events):
+        r = EventRecord.from_event(e, i % 10 + 1)
+        r.start.astimezone(tz)
+        r.end.astimezone(tz)
+    after = time.perf_counter() - t0
+
+    per = 1000 / n
+    print('event parsing, per 1,000 events:')
+    print(f'  dateparser.parse   {before * per * 1000:9.2f} ms')
+    print(f'  EventRecord        {after * per * 1000:9.2f} ms  ({before / after:.0f}x faster)')
+
+
+def synthetic_records(n: int, rooms: int = 10) -> list:
+    from event_store import EventRecord
+    return [EventRecord.from_event(e, i % rooms + 1) for i, e in enumerate(synthetic_events(n))]
+
+
+def _render_run(backend: str, view: str, n: int, repeat: int, profile: str = 'png') -> tuple:
+    '''Runs in a fresh process so peak RSS belongs to one backend only.'''
+    import resource
+    import schedule_render
+    records = synthetic_records(n)
+    monday = datetime(2022, 5, 2, tzinfo=tz)
+    layouts = {
+        'day': lambda: schedule_render.layout_day(monday, [r for r in records if r.start.weekday() == 0]),
+        'week': lambda: schedule_render.layout_week(3, [r for r in records if r.room == 4]),
+        'all': lambda: schedule_render.layout_all(monday, records),
+    }
+    schedule_render.render(layouts[view](), backend, profile)     # warm up imports and fonts
+    t0 = time.perf_counter()
+    for _ in range(repeat):
+        size = len(schedule_render.render(layouts[view](), backend, profile).getvalue())
+    elapsed = (time.perf_counter() - t0) / repeat
+    return elapsed, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, size
+
+
+def bench_render(n: int = 200, repeat: int = 5) -> None:
+    import multiprocessing
+    ctx = multiprocessing.get_context('spawn')
+    print(f'render time and peak RSS, {n} bookings, mean of {repeat}:')
+    for view in ('day', 'week', 'all'):
+        for backend in ('matplotlib', 'pillow'):
+            with ctx.Pool(1) as pool:
+                elapsed, rss, size = pool.apply(_render_run, (backend, view, n, repeat))
+            print(f'  {view:5} {backend:10} {elapsed * 1000:8.1f} ms  {rss / 1024:7.1f} MB peak  {size / 1024:7.1f} KB')
+
+
+def _rss() -> int:
+    '''Current resident set size in KB (linux).'''
+    import os
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') // 1024
+
+
+def _stress_run(backend: str, renders: int, threads: int) -> tuple:
+    from concurrent.futures import ThreadPoolExecutor
+    import schedule_render
+    records = synthetic_records(200)
+    rooms = [[r for r in records if r.room == room + 1] for room in range(10)]
+    expected = {room: schedule_render.render(schedule_render.layout_week(room, rooms[room]), backend).getvalue()
+                for room in range(10)}
+
+    def one(i: int) -> bool:
+        room = i % 10
+        png = schedule_render.render(schedule_render.layout_week(room, rooms[room]), backend).getvalue()
+        return png == expected[room]
+
+    samples = []
+    mismatched = 0
+    with ThreadPoolExecutor(threads) as pool:
+        for i, ok in enumerate(pool.map(one, range(renders))):
+            mismatched += not ok
+            if (i + 1) % (renders // 5) == 0:
+                samples.append(_rss())
+    return samples, mismatched
+
+
+# RSS may grow this much between the first and last fifth of a stress run, a figure
+# leaked per render grows it by far more
+STRESS_RSS_TOLERANCE_MB = 10
+
+
+def bench_render_stress(renders: int = 500, threads: int = 8) -> None:
+    '''Concurrent renders must not mix up figures and RSS must stay flat.'''
+    import multiprocessing
+    ctx = multiprocessing.get_context('spawn')
+    print(f'{renders} concurrent week renders on {threads} threads, RSS after each fifth:')
+    failures = []
+    for backend in ('matplotlib', 'pillow'):
+        with ctx.Pool(1) as pool:
+            samples, mismatched = pool.apply(_stress_run, (backend, renders, threads))
+        growth = (samples[-1] - samples[0]) / 1024
+        rss = '  '.join(f'{kb / 1024:6.1f}' for kb in samples)
+        print(f'  {backend:10} {rss} MB  growth {growth:+.1f} MB  {mismatched} wrong images')
+        if mismatched:
+            failures.append(f'{backend}: {mismatched} wrong images')
+        if growth > STRESS_RSS_TOLERANCE_MB:
+            failures.append(f'{backend}: RSS grew {growth:.1f} MB')
+    # checked after both backends have printed
+    assert not failures, ', '.join(failures)
+
+
+def bench_tiles(n: int = 200, repeat: int = 5) -> None:
+    '''Pillow redraw after one booking changes, against a redraw from scratch.'''
+    import schedule_render
+    from event_store import EventRecord
+    records = synthetic_records(n)
+    monday = datetime(2022, 5, 2, tzinfo=tz)
+
+    def edited(i: int) -> list:
+        changed = list(records)
+        r = changed[i % n]
+        changed[i % n] = EventRecord(r.id, f'{r.summary} v{i}', r.room, r.start, r.end, r.updated)
+        return changed
+
+    print(f'pillow all-rooms view, {n} bookings, mean of {repeat}:')
+    schedule_render.render(schedule_render.layout_all(monday, records), 'pillow')     # warm up fonts
+    for label, clear in (('full redraw', True), ('one booking changed', False)):
+        schedule_render.render(schedule_render.layout_all(monday, records), 'pillow')
+        t0 = time.perf_counter()
+        for i in range(repeat):
+            if clear:
+                schedule_render._frame.cache_clear()
+                schedule_render._tile.cache_clear()
+            schedule_render.render(schedule_render.layout_all(monday, edited(i)), 'pillow')
+        print(f'  {label:20} {(time.perf_counter() - t0) / repeat * 1000:8.1f} ms')
+    print(f'  {schedule_render.tile_stats()["tiles"]}')
+
+
+def bench_density(sizes: tuple = (50, 200, 1000), repeat: int = 3) -> None:
+    '''Render time of the all-rooms view as the week fills up.'''
+    import multiprocessing
+    ctx = multiprocessing.get_context('spawn')
+    print(f'all-rooms view render time by bookings per week, mean of {repeat}:')
+    for n in sizes:
+        for backend in ('matplotlib', 'pillow'):
+            with ctx.Pool(1) as pool:
+                elapsed, rss, size = pool.apply(_render_run, (backend, 'all', n, repeat))
+            print(f'  {n:5} {backend:10} {elapsed * 1000:8.1f} ms  {rss / 1024:7.1f} MB peak')
+
+
+def bench_profiles(n: int = 200, repeat: int = 3) -> None:
+    '''Render time and size of the all-rooms view in each output profile.'''
+    import multiprocessing
+    from schedule_render import PROFILES
+    ctx = multiprocessing.get_context('spawn')
+    print(f'all-rooms view by output profile, {n} bookings, mean of {repeat}:')
+    for backend in ('matplotlib', 'pillow'):
+        for profile in PROFILES:
+            with ctx.Pool(1) as pool:
+                elapsed, rss, size = pool.apply(_render_run, (backend, 'all', n, repeat, profile))
+            print(f'  {backend:10} {profile:9} {elapsed * 1000:8.1f} ms  {size / 1024:7.1f} KB')
+
+
+def bench_persistence_writes(sizes: tuple = (100, 10_000, 100_000)) -> None:
+    '''Bytes sent to the database for one update, by number of users.
+
+    Runs PostgresPersistence on an in-memory SQLite database and reads the queries it
+    would send to PostgreSQL without executing them.
+    '''
+    import json
+    from sqlalchemy import create_engine
+    from sqlalchemy.orm import sessionmaker, scoped_session
+    from sqlalchemy.pool import StaticPool
+    from postgrespersistence import PostgresPersistence, _query_bytes
+    print('bytes written per update, by number of users:')
+    print(f'  {"users":>7} {"update":24} {"whole blob":>12} {"whole row":>10} {"patched":>8}')
+    for n in sizes:
+        engine = create_engine('sqlite://', poolclass=StaticPool, connect_args={'check_same_thread': False})
+        pers = PostgresPersistence(session=scoped_session(sessionmaker(bind=engine)), on_flush=True)
+        users = {str(i): {'rankname': f'CPT TAN {i}', 'unit': '41', 'admin': False} for i in range(n)}
+        pers.update_bot_data({'users': users, 'approved': [], 'booking_requests': {}})
+        for i in range(n):
+            pers.update_user_data(i, {'nric': f'{i:04}A', 'phone': f'9{i:07}', 'rankname': f'CPT TAN {i}'})
+        pers.flush()
+
+        def blob() -> int:
+            return len('UPDATE persistence SET data = :jsondata') + len(json.dumps(
+                {'user_data': pers.user_data, 'bot_data': pers.bot_data}))
+
+        def sent(partial: bool) -> int:
+            '''Bytes of the pending write, with or without jsonb_set patches.'''
+            with pers._dirty_lock:
+                dirty = {table: set(keys) for table, keys in pers._dirty.items()}
+            pers._partial_updates = partial
+            rows, _, _ = pers._dirty_rows()
+            for table, keys in dirty.items():
+                pers._mark_dirty(table, *keys)
+            return _query_bytes(rows)
+
+        updates = {
+            'one user_data key': lambda: pers.update_user_data(1, dict(pers.user_data[1], msgid=42)),
+            'admin granted': lambda: pers.update_bot_data(
+                dict(pers.bot_data, users=dict(users, **{'1': dict(users['1'], admin=True)}))),
+            'unchanged': lambda: pers.update_user_data(2, dict(pers.user_data[2])),
+        }
+        for name, update in updates.items():
+            update()
+            print(f'  {n:7} {name:24} {blob():12} {sent(False):10} {sent(True):8}')
+            pers._partial_updates = False   # sqlite can't run the patches, store the rows whole
+            pers.flush()
+
+
+# what main.py imports before it can answer an update
+MAIN_IMPORTS = ['startup_profile', 'telegram', 'telegram.ext', 'firebasepersistence', 'pytz', 'calendar_generator',
+                'interval_index', 'booking_dates', 'flask']
+
+
+def bench_coldstart(repeat: int = 3) -> None:
+    '''Import time of main.py's dependencies in a fresh interpreter, and the slowest top-level imports.'''
+    import os
+    import subprocess
+    code = 'import ' + ', '.join(MAIN_IMPORTS)
+    here = os.path.dirname(os.path.abspath(__file__))
+    walls = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], cwd=here, capture_output=True, text=True, check=True)
+        walls.append(time.perf_counter() - t0)
+    # lines look like "import time: self [us] | cumulative | imported package", nesting shown by indentation
+    top = []
+    for line in proc.stderr.splitlines():
+        parts = line.split('|')
+        if len(parts) != 3 or not parts[1].strip().isdigit():
+            continue
+        name = parts[2]
+        if name.startswith(' ') and not name.startswith('  '):
+            top.append((int(parts[1]), name.strip()))
+    print(f'cold import of main.py dependencies: {min(walls) * 1000:.0f} ms best of {repeat} (interpreter start included)')
+    for cumulative, name in sorted(top, reverse=True)[:8]:
+        print(f'  {name:28} {cumulative / 1000:8.1f} ms')
+
+
+BENCHMARKS = {
+    'parse': bench_event_parsing,
+    'render': bench_render,
+    'stress': bench_render_stress,
+    'tiles': bench_tiles,
+    'density': bench_density,
+    'profiles': bench_profiles,
+    'coldstart': bench_coldstart,
+    'persistence': bench_persistence_writes,
+}
+
+
+def main(names: list) -> None:
+    for name in names or BENCHMARKS:
+        BENCHMARKS[name]()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,74 @@
+'''
+Parsing for the dates users type into the bot.
+
+The usual inputs (DD/MM/YYYY, DD/MM, DD MMM, today, tomorrow and weekday
+names) are handled here directly. Anything else falls back to dateparser,
+which is imported on first use. Results are memoized per input and day.
+'''
+import re
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache
+
+tz = timezone(timedelta(hours=8))
+MONTHS = ['january', 'february', 'march', 'april', 'may', 'june', 'july', 'august', 'september', 'october', 'november', 'december']
+WEEKDAYS = ['monday', 'tuesday', 'wednesday', 'thursday', 'friday', 'saturday', 'sunday']
+NUMERIC_DATE = re.compile(r'^(\d{1,2})[/.-](\d{1,2})(?:[/.-](\d{4}|\d{2}))?$')
+DAY_MONTH = re.compile(r'^(\d{1,2})(?:st|nd|rd|th)?\s+([a-z]{3,9})\.?(?:\s+(\d{4}))?$')
+
+parse_stats = {'fast': 0, 'fallback': 0}
+
+
+def parse_date(text: str):
+    '''Returns the naive date (at midnight) the user meant, or None if it isn't a date.'''
+    if text is None:
+        return None
+    text = ' '.join(text.strip().lower().split())
+    if not text:
+        return None
+    return _parse_cached(text, datetime.now(tz).date())
+
+
+@lru_cache(maxsize=1024)
+def _parse_cached(text: str, today):
+    d = _parse_fast(text, today)
+    if d is not None:
+        parse_stats['fast'] += 1
+        return d
+    parse_stats['fallback'] += 1
+    import dateparser
+    return dateparser.parse(text, settings={'DATE_ORDER': 'DMY'})
+
+
+def _parse_fast(text: str, today):
+    midnight = datetime.combine(today, datetime.min.time())
+    if text == 'today':
+        return midnight
+    if text == 'tomorrow':
+        return midnight + timedelta(days=1)
+    for i, name in enumerate(WEEKDAYS):
+        if text == name or text == name[:3]:
+            # the next one, counting today
+            return midnight + timedelta(days=(i - today.weekday()) % 7)
+    m = NUMERIC_DATE.match(text)
+    if m is not None:
+        return _build(int(m.group(1)), int(m.group(2)), m.group(3), today)
+    m = DAY_MONTH.match(text)
+    if m is not None:
+        for i, name in enumerate(MONTHS):
+            # "sep", "sept" and "september" all match
+            if name.startswith(m.group(2)):
+                return _build(int(m.group(1)), i + 1, m.group(3), today)
+    return None
+
+
+def _build(day: int, month: int, year, today):
+    if year is None:
+        year = today.year
+    else:
+        year = int(year)
+        if year < 100:
+            year += 2000
+    try:
+        return datetime(year, month, day)
+    except ValueError:
+        return None
@@ -1,58 +1,264 @@
-import matplotlib
-matplotlib.use('AGG')
-import matplotlib.pyplot as plt
 from datetime import datetime, timedelta, timezone
 import os
 import io
 import json
-import dateparser
 import logging
 import base64
+import threading
+import time
+import multiprocessing
+from concurrent.futures import Future, ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 # for plotting the schedules
-import matplotlib.patches as mpatches
-from matplotlib.patches import Rectangle
-import numpy as np
-# stuff for google calendar api
-from os import path
-from google.auth.transport.requests import Request
-from google_auth_oauthlib.flow import InstalledAppFlow
-from oauth2client.service_account import ServiceAccountCredentials
-from googleapiclient.discovery import build
+from schedule_render import layout_day, layout_week, layout_all, render_bytes
+# the google api client libraries are imported by get_calendar_service, on first use
+from event_store import EventStore, EventRecord
+from image_cache import ImageCache, event_fingerprint
+from single_flight import SingleFlight
 
 # PERMISSIONS FOR API ACCESS
 SCOPES = ['https://www.googleapis.com/auth/calendar.events', 'https://www.googleapis.com/auth/calendar']
-colors=['pink', 'lightgreen', 'lightblue', 'wheat', 'salmon', 'thistle', 'yellowgreen', 'azure', 'khaki', 'maroon']    
 tz = timezone(timedelta(hours=8))
-ROOMS = ['L1 Ops Hub', 'L1 Mercury\nPlanning Room', 'L2 Venus\nPlanning Room', 'L3 Terra\nPlanning Room', 'Fortitude', 'Spark', 'Steadfast', 'Gearbox', 'Forward Laager', 'TRACKED VEHICLE\nMOVEMENT']
 logger = logging.getLogger(__name__)
 
-def get_event_list(calendarIds: list, start: datetime, end: datetime) -> list:
+# cached calendar service, shared by every caller in the process
+_service_lock = threading.Lock()
+_service = None
+_service_key = None
+_http = None
+# one connection per calendar, enough for a full parallel fetch
+CALENDAR_POOL_SIZE = int(os.environ.get('CALENDAR_POOL_SIZE', 10))
+service_stats = {'hits': 0, 'builds': 0}
+
+# shared by all threads, so it also caps the calendar requests in flight
+CALENDAR_FETCH_WORKERS = int(os.environ.get('CALENDAR_FETCH_WORKERS', 10))
+_fetch_pool = ThreadPoolExecutor(max_workers=CALENDAR_FETCH_WORKERS, thread_name_prefix='calendar-fetch')
+# 'concurrent' runs one request per calendar on the pool, 'batch' packs them into one batch
+# request, both for direct reads and for syncing the mirrors
+CALENDAR_FETCH_MODE = os.environ.get('CALENDAR_FETCH_MODE', 'concurrent')
+# google rejects batches with more than 50 calls
+BATCH_LIMIT = 50
+
+# how long, in seconds, mirrored events are served before the next incremental sync
+EVENT_STORE_MAX_AGE = float(os.environ.get('EVENT_STORE_MAX_AGE', 60))
+# how many days back the mirror loads, older reads go to the api
+EVENT_STORE_WINDOW_DAYS = float(os.environ.get('EVENT_STORE_WINDOW_DAYS', 7))
+event_store = EventStore(timedelta(days=EVENT_STORE_WINDOW_DAYS))
+
+# 'matplotlib' or 'pillow', can also be chosen per call
+RENDER_BACKEND = os.environ.get('RENDER_BACKEND', 'matplotlib')
+# output profile (see schedule_render.PROFILES) of each view, RENDER_PROFILE_DAY etc. override RENDER_PROFILE
+RENDER_PROFILE = os.environ.get('RENDER_PROFILE', 'png')
+VIEW_PROFILES = {view: os.environ.get(f'RENDER_PROFILE_{view.upper()}', RENDER_PROFILE) for view in ('day', 'week', 'all')}
+# rendered images kept, keyed by view and checked against the events they show
+IMAGE_CACHE_SIZE = int(os.environ.get('IMAGE_CACHE_SIZE', 64))
+image_cache = ImageCache(IMAGE_CACHE_SIZE)
+# telegram file_ids kept per view, the oldest views are dropped past this
+FILE_ID_LIMIT = 256
+
+# renders run in worker processes so they use more than one core and keep the
+# webhook threads free; 0 renders in the calling thread instead
+RENDER_PROCESSES = int(os.environ.get('RENDER_PROCESSES', 2))
+# renders allowed to wait for a free process before new ones are turned away
+RENDER_QUEUE_SIZE = int(os.environ.get('RENDER_QUEUE_SIZE', 8))
+_render_pool_lock = threading.Lock()
+_render_pool = None
+_render_slots = threading.BoundedSemaphore(max(RENDER_PROCESSES, 1) + RENDER_QUEUE_SIZE)
+render_stats = {'submitted': 0, 'rejected': 0, 'pool_restarts': 0}
+
+# identical fetches and renders that overlap in time share one run
+fetch_flight = SingleFlight()
+render_flight = SingleFlight()
+
+class RenderQueueFull(Exception):
+    '''Every render process is busy and RENDER_QUEUE_SIZE renders are already waiting.'''
+
+def _to_record(event: dict, room: int, records: bool = False):
+    if records:
+        return EventRecord.from_event(event, room)
+    return {
+        'summary':event['summary'],
+        'start':event['start'],
+        'end':event['end'],
+        'id':event['id'],
+        'room':room,
+    }
+
+def _fetch_calendar(service, calendarId: str, room: int, start: datetime, end: datetime, records: bool = False) -> list:
+    event_list = []
+    page_token = None
+    while True:
+        events = service.events().list(
+            calendarId=calendarId,
+            pageToken=page_token,
+            timeMin=start.isoformat(),
+            timeMax = end.isoformat(),
+            orderBy='startTime',
+            singleEvents=True,
+        ).execute()
+        for event in events['items']:
+            event_list.append(_to_record(event, room, records))
+        page_token = events.get('nextPageToken')
+        if not page_token:
+            break
+    return event_list
+
+def _fetch_mirrored(service, calendarId: str, room: int, start: datetime, end: datetime, records: bool, max_age: float) -> list:
+    event_store.refresh(service, calendarId, max_age)
+    found = event_store.query(calendarId, start, end)
+    if found is None:
+        # from before what the mirror holds
+        return _fetch_calendar(service, calendarId, room, start, end, records)
+    if records:
+        # the mirror has already parsed the times
+        return [EventRecord(e['id'], e['summary'], room, start_t, end_t, e.get('updated')) for start_t, end_t, e in found]
+    return [_to_record(e, room) for _, _, e in found]
+
+def _fetch_synced(service, calendarId: str, room: int, start: datetime, end: datetime, records: bool, failed: dict) -> list:
+    '''Reads a calendar EventStore.refresh_batch has just synced, or raises what its sync failed with.'''
+    if calendarId in failed:
+        raise failed[calendarId]
+    return _fetch_mirrored(service, calendarId, room, start, end, records, float('inf'))
+
+def get_event_list(calendarIds: list, start: datetime, end: datetime, errors: dict = None, max_age: float = None, records: bool = False) -> list:
+    '''Returns the events of every calendar in calendarIds that overlap [start, end).
+
+    Events are served from the in-process mirror, which is synced first if it
+    is older than max_age seconds (EVENT_STORE_MAX_AGE by default; a negative
+    value queries the api directly). Calendars are fetched in parallel when
+    there is more than one.
+
+    Events keep the order of calendarIds, and 'room' is the 1-based index of
+    the calendar they came from. If errors is given, a failing calendar is
+    recorded there as {room: exception} and the other calendars are still
+    returned, otherwise the first failure is raised.
+
+    With records=True the events come back as EventRecord objects, with start
+    and end already parsed, instead of dicts.
+
+    Callers asking for the same thing while a fetch is in flight wait for
+    that fetch instead of starting another.
+    '''
+    if max_age is None:
+        max_age = EVENT_STORE_MAX_AGE
+    key = (tuple(calendarIds), start, end, errors is not None, max_age, records)
+    event_list, failed = fetch_flight.do(key, _get_event_list, list(calendarIds), start, end, errors is not None, max_age, records)
+    if errors is not None:
+        errors.update(failed)
+    # every caller gets a list of its own
+    return list(event_list)
+
+def _get_event_list(calendarIds: list, start: datetime, end: datetime, collect_errors: bool, max_age: float, records: bool) -> tuple:
+    errors = {} if collect_errors else None
+    batch = CALENDAR_FETCH_MODE == 'batch' and len(calendarIds) > 1
+    if batch and (max_age < 0 or not event_store.in_window(start)):
+        return get_event_list_batch(calendarIds, start, end, errors, records), errors or {}
     service = get_calendar_service()
+    if batch:
+        # every stale calendar is synced in the same batch, then read from memory
+        failed = event_store.refresh_batch(service, calendarIds, max_age, _execute_batch)
+        fetch, extra = _fetch_synced, (records, failed)
+    elif max_age >= 0:
+        fetch, extra = _fetch_mirrored, (records, max_age)
+    else:
+        fetch, extra = _fetch_calendar, (records,)
+    if batch:
+        # already in memory, not worth the pool
+        futures = [_run_inline(fetch, service, calendarId, i, start, end, *extra) for i, calendarId in enumerate(calendarIds, start=1)]
+    elif len(calendarIds) == 1:
+        futures = [_run_inline(fetch, service, calendarIds[0], 1, start, end, *extra)]
+    else:
+        futures = [
+            _fetch_pool.submit(fetch, service, calendarId, i, start, end, *extra)
+            for i, calendarId in enumerate(calendarIds, start=1)
+        ]
     event_list = []
-    for i,calendarId in enumerate(calendarIds, start=1):
-        page_token = None
-        while True:
-            events = service.events().list(
-                calendarId=calendarId,
+    for i, future in enumerate(futures, start=1):
+        try:
+            event_list.extend(future.result())
+        except Exception as e:
+            if errors is None:
+                raise
+            logger.warning(f'failed to fetch events for calendar {i}: {e}')
+            errors[i] = e
+    return event_list, errors or {}
+
+def get_event_list_batch(calendarIds: list, start: datetime, end: datetime, errors: dict = None, records: bool = False) -> list:
+    '''Same as get_event_list, but sends the per-calendar list calls through the batch endpoint.
+
+    Calendars that return a nextPageToken are carried into the next batch, so
+    a fetch costs one round trip per page depth instead of one per calendar.
+    '''
+    service = get_calendar_service()
+    pages = {room: [] for room in range(1, len(calendarIds)+1)}
+    failed = {}
+    pending = {room: None for room in pages}    # room -> page token
+    while pending:
+        calls = [
+            service.events().list(
+                calendarId=calendarIds[room-1],
                 pageToken=page_token,
                 timeMin=start.isoformat(),
                 timeMax = end.isoformat(),
                 orderBy='startTime',
                 singleEvents=True,
-            ).execute()
+            )
+            for room, page_token in pending.items()
+        ]
+        rooms = list(pending.keys())
+        pending = {}
+        for room, (events, exception) in zip(rooms, _execute_batch(service, calls)):
+            if exception is not None:
+                failed[room] = exception
+                continue
             for event in events['items']:
-                event_list.append({
-                    'summary':event['summary'],
-                    'start':event['start'],
-                    'end':event['end'],
-                    'id':event['id'],
-                    'room':i,
-                })
-            page_token = events.get('nextPageToken')
-            if not page_token:
-                break
+                pages[room].append(_to_record(event, room, records))
+            if events.get('nextPageToken'):
+                pending[room] = events['nextPageToken']
+    event_list = []
+    for room, events in pages.items():
+        if room in failed:
+            if errors is None:
+                raise failed[room]
+            logger.warning(f'failed to fetch events for calendar {room}: {failed[room]}')
+            errors[room] = failed[room]
+            continue
+        event_list.extend(events)
     return event_list
 
+def insert_event(calendarId: str, booking: dict) -> dict:
+    service = get_calendar_service()
+    e = service.events().insert(calendarId=calendarId, body=booking).execute()
+    event_store.apply_insert(calendarId, e)
+    image_cache.invalidate(calendarId)
+    return e
+
+def delete_event(calendarId: str, eventId: str) -> None:
+    service = get_calendar_service()
+    service.events().delete(calendarId=calendarId, eventId=eventId).execute()
+    event_store.apply_delete(calendarId, eventId)
+    image_cache.invalidate(calendarId)
+
+def _execute_batch(service, calls: list) -> list:
+    '''Runs calls through the batch endpoint, BATCH_LIMIT per request, and returns (response, exception) pairs in order.'''
+    results = [(None, None)] * len(calls)
+    def callback(request_id, response, exception):
+        results[int(request_id)] = (response, exception)
+    for offset in range(0, len(calls), BATCH_LIMIT):
+        batch = service.new_batch_http_request(callback=callback)
+        for i, call in enumerate(calls[offset:offset+BATCH_LIMIT], start=offset):
+            batch.add(call, request_id=str(i))
+        batch.execute()
+    return results
+
+def _run_inline(fn, *args) -> Future:
+    future = Future()
+    try:
+        future.set_result(fn(*args))
+    except Exception as e:
+        future.set_exception(e)
+    return future
+
 def init_testing_local():
     with open('key64.txt','r') as keyfile:
         keys_64 = keyfile.read()
@@ -66,180 +272,179 @@ def init_testing_local():
     return
 
 def get_calendar_service():
-    creds = None
+    '''Returns the process-wide calendar service, building it on first use.
+
+    The service is rebuilt only when GOOGLE_APPLICATION_CREDENTIALS changes. The
+    discovery document is read from the copy bundled with googleapiclient, and
+    the credentials keep their access token until it expires. Requests go
+    through a pooled keep-alive transport that is safe to share between threads.
     '''
-    if path.exists("token.txt"):
-        creds = pickle.load(open("token.txt", "rb"))
-    # IF IT EXPIRED, WE REFRESH THE CREDENTIALS
-    if not creds or not creds.valid:
-        if creds and creds.expired and creds.refresh_token:
-            creds.refresh(Request())
-        else:
-            creds = get_crendetials_google()
+    global _service, _service_key, _http
+    key = os.environ["GOOGLE_APPLICATION_CREDENTIALS"]
+    with _service_lock:
+        if _service is not None and _service_key == key:
+            service_stats['hits'] += 1
+            return _service
+        from google.oauth2 import service_account
+        from googleapiclient.discovery import build
+        from pooled_http import PooledHttp
+        creds = service_account.Credentials.from_service_account_info(json.loads(key), scopes=SCOPES)
+        _http = PooledHttp(creds, pool_maxsize=CALENDAR_POOL_SIZE)
+        _service = build("calendar", "v3", http=_http, static_discovery=True, cache_discovery=False)
+        _service_key = key
+        service_stats['builds'] += 1
+        logger.info(f'calendar service built ({service_stats["builds"]} builds, {service_stats["hits"]} hits)')
+        return _service
+
+def get_service_stats() -> dict:
+    with _service_lock:
+        stats = dict(service_stats)
+        if _http is not None:
+            stats['transport'] = _http.get_stats()
+    stats['fetch_flight'] = fetch_flight.get_stats()
+    stats['render_flight'] = render_flight.get_stats()
+    return stats
+
+def _render_cached(key: tuple, calendarIds: list, event_list: list, errors: dict, make_layout, backend: str, file_ids: dict = None, profile: str = None):
+    '''Renders make_layout(), or returns the cached image of key if it shows the same events.
+
+    If file_ids has a telegram file_id for this view drawn from the same
+    events, that file_id is returned instead and nothing is rendered.
+    Otherwise the image is a BytesIO carrying its view and fingerprint, for
+    remember_file_id once it has been sent.
     '''
-    # key_file_location = 'msvskey.json'
-    creds = ServiceAccountCredentials.from_json_keyfile_dict(json.loads(os.environ["GOOGLE_APPLICATION_CREDENTIALS"]), scopes=SCOPES)
-    service = build("calendar", "v3", credentials=creds)
+    backend = backend or RENDER_BACKEND
+    profile = profile or VIEW_PROFILES[key[0]]
+    key = key + (backend, profile)
+    fingerprint = event_fingerprint(event_list)
+    view = ':'.join(str(k) for k in key)
+    if file_ids is not None and not errors:
+        sent = file_ids.get(view)
+        if sent is not None and sent[0] == fingerprint:
+            return sent[1]
+    image = image_cache.get(key, fingerprint)
+    if image is None:
+        image = render_flight.do((key, fingerprint), lambda: _render_bytes(make_layout(), backend, profile))
+        # an image missing a calendar that failed to load is not worth keeping
+        if not errors:
+            image_cache.put(key, fingerprint, calendarIds, image)
+    buf = io.BytesIO(image)
+    buf.view = view
+    buf.fingerprint = fingerprint if not errors else None
+    return buf
+
+def _get_render_pool() -> ProcessPoolExecutor:
+    global _render_pool
+    with _render_pool_lock:
+        if _render_pool is None:
+            # spawn, not fork: this process has threads that may hold locks
+            _render_pool = ProcessPoolExecutor(max_workers=RENDER_PROCESSES, mp_context=multiprocessing.get_context('spawn'))
+        return _render_pool
 
-    return service
+def _render_bytes(layout: dict, backend: str, profile: str) -> bytes:
+    '''Renders layout on the render processes. Raises RenderQueueFull rather than queueing without bound.'''
+    global _render_pool
+    if RENDER_PROCESSES <= 0:
+        return render_bytes(layout, backend, profile)
+    if not _render_slots.acquire(blocking=False):
+        render_stats['rejected'] += 1
+        raise RenderQueueFull(f'{RENDER_PROCESSES} renders running and {RENDER_QUEUE_SIZE} waiting')
+    pool = _get_render_pool()
+    try:
+        future = pool.submit(render_bytes, layout, backend, profile)
+    except BaseException:
+        _render_slots.release()
+        raise
+    render_stats['submitted'] += 1
+    future.add_done_callback(lambda f: _render_slots.release())
+    try:
+        return future.result()
+    except BrokenProcessPool:
+        # a worker died (most likely out of memory), start a fresh pool for the next render
+        with _render_pool_lock:
+            if _render_pool is pool:
+                _render_pool = None
+                render_stats['pool_restarts'] += 1
+        raise
 
-def createImageDay(day:datetime):
-    booking_date = day.strftime('%d/%m/%Y')
+def remember_file_id(file_ids: dict, img, file_id: str) -> None:
+    '''Records the file_id telegram gave an image from createImage*, so the next identical view reuses it.'''
+    if isinstance(img, str) or img.fingerprint is None:
+        return
+    file_ids.pop(img.view, None)
+    file_ids[img.view] = [img.fingerprint, file_id]
+    while len(file_ids) > FILE_ID_LIMIT:
+        del file_ids[next(iter(file_ids))]
+
+def createImageDay(day:datetime, backend: str = None, file_ids: dict = None, profile: str = None):
     cal_ids = json.loads(os.environ.get("CALENDAR_ID"))
     daystart_dt = day.astimezone(tz)
     dayend_dt = (day+timedelta(days=1)).astimezone(tz)
-    event_list = get_event_list(cal_ids, daystart_dt, dayend_dt)
-    
-    plt.figure(figsize=(10, 8))
-    # non days are grayed
-    ax = plt.gca().axes
-        
-    ax.tick_params(axis='both', which='major', labelsize=8)
-    ax.tick_params(axis='both', which='minor', length=0)
-    for e in event_list:
-        event=e['summary']
-        room=e['room']-1
-        start_t = dateparser.parse(e['start']['dateTime']).astimezone(tz)
-        end_t = dateparser.parse(e['end']['dateTime']).astimezone(tz)
-        start=start_t.hour+start_t.minute/60
-        end=end_t.hour+end_t.minute/60
-        if(end<7 or start>18):
-            continue
-        # plot event
-        ax.add_patch(Rectangle((end, room), width=(start-end), height=1, color=colors[room], alpha=1, ec='k',lw=0.7))
-        #plot name of booking
-        plt.text((start+end)/2, room+0.5, f'''{event}''', va='center', ha='center', fontsize=5)
-        # plot beginning time
-        plt.text(start+0.01, room+0.95, f'''{start_t.strftime('%H:%M')}''', va='top', fontsize=4)
-        #plot end time
-        plt.text(end-0.01, room+0.05, f'''{end_t.strftime('%H:%M')}''', va='bottom', ha='right', fontsize=4)
-
-    plt.xticks(np.arange(7,19), [f'{n:02}:00' for n in np.arange(7,19)])
-    ax.set_xticks(np.arange(7,19,0.25), minor=True)
-    plt.yticks(np.arange(0,10)+.5, ROOMS)
-    plt.grid(axis='x', alpha=0.5, which='minor')
-    plt.grid(axis='x', alpha=0.5, which='major', lw=1.2)
-    plt.ylim(0, 10)
-    plt.xlim(7.5, 18.5)
-
-    plt.title(booking_date)
-    for y in range(1,10):
-        plt.axhline(y=y, color='k', lw=1) 
-    buf = io.BytesIO()
-    plt.savefig(buf, format='png', dpi=150, bbox_inches='tight')
-    buf.seek(0)
-    return buf
+    errors = {}
+    event_list = get_event_list(cal_ids, daystart_dt, dayend_dt, errors=errors, records=True)
+    return _render_cached(('day', day.date().isoformat()), cal_ids, event_list, errors,
+        lambda: layout_day(day, event_list), backend, file_ids, profile)
 
-def createImageWeek(facility:int):
-    weekdays = ['Monday','Tuesday','Wednesday','Thursday','Friday']
+def createImageWeek(facility:int, backend: str = None, file_ids: dict = None, profile: str = None):
     cal_ids = json.loads(os.environ.get("CALENDAR_ID"))
-    now = datetime.now()
+    now = datetime.now(tz)
     monday = now - timedelta(days = now.weekday())
     monday = datetime.combine(monday.date(), datetime.min.time(), tzinfo=tz)
     weekstart_dt = monday.astimezone(tz)
     weekend_dt = (monday+timedelta(days=5)).astimezone(tz)
-    event_list = get_event_list([cal_ids[facility]], weekstart_dt, weekend_dt)
-    plt.figure(figsize=(10, 4))
-    # non days are grayed
-    ax = plt.gca().axes
-        
-    ax.tick_params(axis='both', which='major', labelsize=8)
-    ax.tick_params(axis='both', which='minor', length=0)
-    for e in event_list:
-        event=e['summary']
-        start_t = dateparser.parse(e['start']['dateTime']).astimezone(tz)
-        end_t = dateparser.parse(e['end']['dateTime']).astimezone(tz)
-        day = start_t.date().weekday()
-        start=start_t.hour+start_t.minute/60
-        end=end_t.hour+end_t.minute/60
-        if(end<7 or start>18):
-            continue
-        # plot event
-        ax.add_patch(Rectangle((end, day), width=(start-end), height=1, color=colors[day-1], alpha=1, ec='k',lw=0.7))
-        #plot name of booking
-        plt.text((start+end)/2, day+0.5, f'''{event}''', va='center', ha='center', fontsize=5)
-        # plot beginning time
-        plt.text(start+0.02, day+0.05, f'''{start_t.strftime('%H:%M')}''', va='top', fontsize=4)
-        #plot end time
-        plt.text(end-0.02, day+0.95, f'''{end_t.strftime('%H:%M')}''', va='bottom', ha='right', fontsize=4)
-
-    plt.xticks(np.arange(7,19), [f'{n:02}:00' for n in np.arange(7,19)])
-    ax.set_xticks(np.arange(7,19,0.25), minor=True)
-    plt.yticks(np.arange(0,5)+.5, weekdays)
-    plt.grid(axis='x', alpha=0.5, which='minor')
-    plt.grid(axis='x', alpha=0.5, which='major', lw=1.2)
-    plt.ylim(0, 5)
-    plt.xlim(7.5, 18.5)
-    plt.gca().invert_yaxis()
-    
-    plt.title(ROOMS[facility].replace('\n',' '))
-    for y in range(1,5):
-        plt.axhline(y=y, color='k', lw=1) 
-    buf = io.BytesIO()
-    plt.savefig(buf, format='png', dpi=150, bbox_inches='tight')
-    buf.seek(0)
-    return buf
+    event_list = get_event_list([cal_ids[facility]], weekstart_dt, weekend_dt, records=True)
+    return _render_cached(('week', facility, monday.date().isoformat()), [cal_ids[facility]], event_list, None,
+        lambda: layout_week(facility, event_list), backend, file_ids, profile)
 
-def createImageAll(now=None):
-    
-    weekdays = ['Monday','Tuesday','Wednesday','Thursday','Friday']
+def createImageAll(now=None, backend: str = None, file_ids: dict = None, profile: str = None):
     cal_ids = json.loads(os.environ.get("CALENDAR_ID"))
     if now is None:
-        now = datetime.now()
+        now = datetime.now(tz)
     monday = now - timedelta(days = now.weekday())
     monday = datetime.combine(monday.date(), datetime.min.time(), tzinfo=tz)
     weekstart_dt = monday.astimezone(tz)
     weekend_dt = (monday+timedelta(days=5)).astimezone(tz)
-    event_list = get_event_list(cal_ids, weekstart_dt, weekend_dt)
-    plt.figure(figsize=(12, 14))
-    # non days are grayed
-    ax = plt.gca().axes
-        
-    ax.tick_params(axis='both', which='major', labelsize=8)
-    ax.tick_params(axis='both', which='minor', length=0)
-    for e in event_list:
-        event=e['summary']
-        room=e['room']-1
-        start_t = dateparser.parse(e['start']['dateTime']).astimezone(tz)
-        end_t = dateparser.parse(e['end']['dateTime']).astimezone(tz)
-        day = start_t.date().weekday()
-        start=start_t.hour+start_t.minute/60
-        end=end_t.hour+end_t.minute/60
-        if(end<7 or start>18):
-            continue
-        # plot event
-        ax.add_patch(Rectangle((end, (day+((room)/10))), width=(start-end), height=0.1, color=colors[room], alpha=1, ec='k',lw=0.7))
-        #plot name of booking
-        plt.text((start+end)/2, (day+((room)/10))+0.05, f'''{event}''', va='center', ha='center', fontsize=5)
-        # plot beginning time
-        plt.text(start+0.01, (day+((room)/10))+0.01, f'''{start_t.strftime('%H:%M')}''', va='top', fontsize=4)
-        #plot end time
-        plt.text(end-0.01, (day+((room)/10))+0.09, f'''{end_t.strftime('%H:%M')}''', va='bottom', ha='right', fontsize=4)
-
-    plt.xticks(np.arange(7,19), [f'{n:02}:00' for n in np.arange(7,19)])
-    ax.set_xticks(np.arange(7,19,0.25), minor=True)
-    plt.yticks(np.arange(0,5)+.5, weekdays)
-    plt.grid(axis='x', alpha=0.5, which='minor')
-    plt.grid(axis='x', alpha=0.5, which='major', lw=1.2)
-    plt.ylim(0, 5)
-    plt.xlim(7.5, 18.5)
-    plt.gca().invert_yaxis()
-
-    for y in range(1,5):
-        plt.axhline(y=y, color='k', lw=1) 
-    legend_handles = [mpatches.Patch(color=colors[i], label=ROOMS[i]) for i in range(len(ROOMS))]
-    ax.legend(handles=legend_handles, 
-        prop={'size': 5},
-        bbox_to_anchor=(0., 1.02, 1., .102), 
-        loc='upper left',
-        ncol=5, mode="expand", 
-        borderaxespad=0.
-    )
-    plt.title(f'''All bookings, week of {monday.strftime('%d/%m/%Y')}''')
-    buf = io.BytesIO()
-    plt.savefig(buf, format='png', dpi=150, bbox_inches='tight')
-    buf.seek(0)
-    return buf
+    errors = {}
+    event_list = get_event_list(cal_ids, weekstart_dt, weekend_dt, errors=errors, records=True)
+    return _render_cached(('all', monday.date().isoformat()), cal_ids, event_list, errors,
+        lambda: layout_all(monday, event_list), backend, file_ids, profile)
+
+def prerender(backend: str = None) -> None:
+    '''Draws the images /view is most likely to be asked for into the image cache.
+
+    That is the overview of this week and next week, each room's week and
+    today's day. Images whose events have not changed are cache hits and cost
+    nothing.
+    '''
+    cal_ids = json.loads(os.environ.get("CALENDAR_ID"))
+    # the bot's day, not the server's: Cloud Run runs on UTC
+    now = datetime.now(tz)
+    today = datetime.combine(now.date(), datetime.min.time(), tzinfo=tz)
+    views = [(createImageAll, now), (createImageAll, now+timedelta(days=7)), (createImageDay, today)]
+    views += [(createImageWeek, facility) for facility in range(len(cal_ids))]
+    _prerender(views, backend)
+
+def prerender_booking(facility: int, when: datetime, backend: str = None) -> None:
+    '''Redraws the views a booking change in facility at when shows up in.'''
+    when = when.astimezone(tz)
+    day = datetime.combine(when.date(), datetime.min.time(), tzinfo=tz)
+    _prerender([(createImageAll, when), (createImageDay, day), (createImageWeek, facility)], backend)
+
+def _prerender(views: list, backend: str) -> None:
+    before = image_cache.get_stats()
+    t0 = time.perf_counter()
+    for create, arg in views:
+        try:
+            create(arg, backend=backend)
+        except RenderQueueFull:
+            # users come first, try again next time
+            logger.info('render queue full, stopping prerender')
+            break
+        except Exception as e:
+            logger.warning(f'prerender of {create.__name__}({arg}) failed: {e}')
+    stats = image_cache.get_stats()
+    drawn = stats['misses'] + stats['stale'] - before['misses'] - before['stale']
+    logger.info(f'prerendered {len(views)} views in {time.perf_counter()-t0:.2f}s, {drawn} redrawn')
 
 def generate_keys64():
     return (base64.b64encode(json.dumps(json.load(open('keys.json','r'))).encode()))
@@ -0,0 +1,277 @@
+'''
+In-process mirror of the booking calendars.
+
+Each calendar is loaded once, from a few days back onwards, and then kept
+up to date with incremental syncToken syncs, so reads are answered from
+memory. Reads from before the loaded window go to the api instead. Our own
+inserts and deletes are written through to the mirror as they happen.
+'''
+import logging
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+
+from interval_index import IntervalIndex
+
+logger = logging.getLogger(__name__)
+tz = timezone(timedelta(hours=8))
+
+
+def event_datetime(t: dict) -> datetime:
+    '''Aware datetime of an event start/end, for timed and all-day events.'''
+    if 'dateTime' in t:
+        # calendar api times are strict RFC3339, so no need for dateparser here
+        return datetime.fromisoformat(t['dateTime'].replace('Z', '+00:00'))
+    return datetime.combine(datetime.fromisoformat(t['date']).date(), datetime.min.time(), tzinfo=tz)
+
+
+def event_timestamp(t: dict) -> float:
+    '''Epoch seconds of an event start/end, for timed and all-day events.'''
+    return event_datetime(t).timestamp()
+
+
+class EventRecord:
+    '''Compact calendar event with start and end parsed once into aware datetimes.'''
+    __slots__ = ('id', 'summary', 'room', 'start', 'end', 'updated')
+
+    def __init__(self, id: str, summary: str, room: int, start: datetime, end: datetime, updated: str = None):
+        self.id = id
+        self.summary = summary
+        self.room = room
+        self.start = start
+        self.end = end
+        self.updated = updated
+
+    @classmethod
+    def from_event(cls, event: dict, room: int):
+        return cls(
+            event['id'],
+            event['summary'],
+            room,
+            event_datetime(event['start']),
+            event_datetime(event['end']),
+            event.get('updated'),
+        )
+
+    def __repr__(self) -> str:
+        return f'EventRecord({self.summary!r}, room={self.room}, {self.start.isoformat()}-{self.end.isoformat()})'
+
+
+class CalendarMirror:
+    def __init__(self, calendarId: str, window: timedelta):
+        self.calendarId = calendarId
+        self.window = window    # how far back the full load goes
+        self.loaded_from = None     # start of the window last loaded in full
+        self.events = {}    # event id -> (start, end, event)
+        self.index = IntervalIndex()
+        self.sync_token = None
+        self.synced_at = None
+        self.lock = threading.Lock()
+
+    def is_stale(self, max_age: float) -> bool:
+        return self.synced_at is None or time.monotonic() - self.synced_at > max_age
+
+    def covers(self, start: float) -> bool:
+        '''Whether the mirror holds every event ending after start.'''
+        return self.loaded_from is not None and start >= self.loaded_from.timestamp()
+
+    def needs_full(self) -> bool:
+        # incremental syncs keep the window's start where it was, so reload
+        # now and then to let go of the old events
+        return self.sync_token is None or self.loaded_from < datetime.now(tz) - 2*self.window
+
+    def sync(self, service) -> tuple:
+        '''Pulls changes since the last sync, or the window on first use. Returns (full, changes).'''
+        from googleapiclient.errors import HttpError
+        full = self.needs_full()
+        try:
+            changes = self._pull(service, full)
+        except HttpError as e:
+            if full or e.resp.status != 410:
+                raise
+            # sync token expired, start over
+            logger.info(f'sync token for {self.calendarId} expired, reloading')
+            full = True
+            changes = self._pull(service, full)
+        self.synced_at = time.monotonic()
+        return full, changes
+
+    def _pull(self, service, full: bool) -> int:
+        self.begin(full)
+        changes = 0
+        page_token = None
+        while True:
+            events = self.list_request(service, full, page_token).execute()
+            changes += self.apply(events)
+            page_token = events.get('nextPageToken')
+            if not page_token:
+                break
+        return changes
+
+    def begin(self, full: bool) -> None:
+        '''Starts a sync, dropping everything held if it is a full one.'''
+        if full:
+            self.events = {}
+            self.index = IntervalIndex()
+            self.sync_token = None
+            self.loaded_from = datetime.now(tz) - self.window
+            # stale until the load completes, so a failed one isn't read from
+            self.synced_at = None
+
+    def list_request(self, service, full: bool, page_token: str = None):
+        '''The events().list request for a page of a full or incremental sync.'''
+        if full:
+            return service.events().list(
+                calendarId=self.calendarId,
+                pageToken=page_token,
+                timeMin=self.loaded_from.isoformat(),
+                singleEvents=True,
+                maxResults=2500,
+            )
+        return service.events().list(
+            calendarId=self.calendarId,
+            pageToken=page_token,
+            syncToken=self.sync_token,
+            singleEvents=True,
+            maxResults=2500,
+        )
+
+    def apply(self, events: dict) -> int:
+        '''Applies a page of a sync. Returns the number of changes in it.'''
+        items = events.get('items', [])
+        for event in items:
+            if event.get('status') == 'cancelled':
+                self.remove(event['id'])
+            else:
+                self.put(event)
+        if not events.get('nextPageToken'):
+            self.sync_token = events.get('nextSyncToken')
+        return len(items)
+
+    def put(self, event: dict) -> None:
+        self.remove(event['id'])
+        start, end = event_datetime(event['start']), event_datetime(event['end'])
+        entry = (start, end, event)
+        self.events[event['id']] = entry
+        self.index.add(start.timestamp(), end.timestamp(), entry)
+
+    def remove(self, eventId: str) -> None:
+        old = self.events.pop(eventId, None)
+        if old is not None:
+            self.index.remove(old[0].timestamp(), old)
+
+    def query(self, start: float, end: float) -> list:
+        '''(start, end, event) entries overlapping [start, end), with start and end as parsed datetimes.'''
+        return self.index.overlapping(start, end)
+
+
+class EventStore:
+    def __init__(self, window: timedelta = timedelta(days=7)):
+        self.window = window
+        self._mirrors = {}
+        self._lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self.stats = {'reads': 0, 'full_syncs': 0, 'incremental_syncs': 0, 'changes': 0, 'writes': 0}
+
+    def mirror(self, calendarId: str) -> CalendarMirror:
+        with self._lock:
+            if calendarId not in self._mirrors:
+                self._mirrors[calendarId] = CalendarMirror(calendarId, self.window)
+            return self._mirrors[calendarId]
+
+    def _count(self, key: str, n: int = 1) -> None:
+        with self._stats_lock:
+            self.stats[key] += n
+
+    def refresh(self, service, calendarId: str, max_age: float) -> None:
+        '''Syncs the calendar if its mirror is older than max_age seconds.'''
+        m = self.mirror(calendarId)
+        with m.lock:
+            if not m.is_stale(max_age):
+                return
+            full, changes = m.sync(service)
+        self._count('full_syncs' if full else 'incremental_syncs')
+        self._count('changes', changes)
+
+    def refresh_batch(self, service, calendarIds: list, max_age: float, execute_batch) -> dict:
+        '''Syncs the stale mirrors among calendarIds together, one batch request per page depth.
+
+        execute_batch(service, requests) runs requests through the batch
+        endpoint and returns (response, exception) pairs in order. Returns
+        {calendarId: exception} for the calendars that could not be synced.
+        '''
+        from googleapiclient.errors import HttpError
+        mirrors = {calendarId: self.mirror(calendarId) for calendarId in sorted(set(calendarIds))}
+        failed = {}
+        # taken in the same order by every batch, so two of them can't deadlock
+        for m in mirrors.values():
+            m.lock.acquire()
+        try:
+            syncs = {}  # calendarId -> [full, changes]
+            pending = {}    # calendarId -> page token
+            for calendarId, m in mirrors.items():
+                if m.is_stale(max_age):
+                    syncs[calendarId] = [m.needs_full(), 0]
+                    m.begin(syncs[calendarId][0])
+                    pending[calendarId] = None
+            while pending:
+                requests = [mirrors[c].list_request(service, syncs[c][0], token) for c, token in pending.items()]
+                calendars = list(pending)
+                pending = {}
+                for calendarId, (events, exception) in zip(calendars, execute_batch(service, requests)):
+                    m = mirrors[calendarId]
+                    if exception is not None:
+                        if syncs[calendarId][0] or not isinstance(exception, HttpError) or exception.resp.status != 410:
+                            failed[calendarId] = exception
+                            continue
+                        # sync token expired, start over
+                        logger.info(f'sync token for {calendarId} expired, reloading')
+                        syncs[calendarId][0] = True
+                        m.begin(True)
+                        pending[calendarId] = None
+                        continue
+                    syncs[calendarId][1] += m.apply(events)
+                    if events.get('nextPageToken'):
+                        pending[calendarId] = events['nextPageToken']
+                    else:
+                        m.synced_at = time.monotonic()
+        finally:
+            for m in mirrors.values():
+                m.lock.release()
+        for calendarId, (full, changes) in syncs.items():
+            if calendarId not in failed:
+                self._count('full_syncs' if full else 'incremental_syncs')
+                self._count('changes', changes)
+        return failed
+
+    def in_window(self, start: datetime) -> bool:
+        '''Whether reads from start on can be answered by the mirror once it is synced.'''
+        return start >= datetime.now(tz) - self.window
+
+    def query(self, calendarId: str, start: datetime, end: datetime) -> list:
+        '''(start, end, event) entries overlapping [start, end), ordered by start time, or
+        None when start is before the loaded window.'''
+        m = self.mirror(calendarId)
+        with m.lock:
+            if not m.covers(start.timestamp()):
+                return None
+            found = m.query(start.timestamp(), end.timestamp())
+        self._count('reads')
+        return found
+
+    def apply_insert(self, calendarId: str, event: dict) -> None:
+        m = self.mirror(calendarId)
+        with m.lock:
+            if m.synced_at is not None:
+                m.put(event)
+        self._count('writes')
+
+    def apply_delete(self, calendarId: str, eventId: str) -> None:
+        m = self.mirror(calendarId)
+        with m.lock:
+            m.remove(eventId)
+        self._count('writes')
+
+    def get_stats(self) -> dict:
+        with self._stats_lock:
+            return dict(self.stats)
@@ -0,0 +1,154 @@
+'''
+In-memory stand-in for the google calendar api, for local testing.
+
+FakeCalendarHttp speaks the same httplib2 interface as PooledHttp, so it can
+be passed to googleapiclient's build(). It serves events().list (with
+paging and syncToken syncs), insert and delete, and the multipart batch
+endpoint, and counts the http round trips it receives. Calendars put in
+failing answer every call with a 500.
+'''
+import email.parser
+import json
+import re
+import threading
+import uuid
+from datetime import datetime, timezone
+from urllib.parse import urlparse, parse_qs, unquote
+
+import httplib2
+
+EVENTS_PATH = re.compile(r'/calendars/([^/]+)/events(?:/([^/]+))?$')
+STATUS_TEXT = {200: 'OK', 204: 'No Content', 400: 'Bad Request', 404: 'Not Found', 500: 'Internal Server Error'}
+
+
+def _parse_dt(s: str) -> datetime:
+    return datetime.fromisoformat(s.replace('Z', '+00:00'))
+
+
+class FakeCalendarHttp:
+    def __init__(self, events: dict = None, page_size: int = 250):
+        # calendarId -> list of event dicts
+        self.events = {k: list(v) for k, v in (events or {}).items()}
+        self.page_size = page_size
+        self.stats = {'requests': 0, 'batches': 0, 'batched_calls': 0}
+        self.failing = set()    # calendarIds that answer with a 500
+        self._lock = threading.Lock()
+        # change log for syncToken syncs: (sequence, calendarId, event)
+        self._changes = []
+        self._seq = 0
+
+    def _log_change(self, calendarId: str, event: dict) -> None:
+        self._seq += 1
+        self._changes.append((self._seq, calendarId, event))
+
+    def add_event(self, calendarId: str, summary: str, start: datetime, end: datetime) -> dict:
+        event = {
+            'id': uuid.uuid4().hex,
+            'summary': summary,
+            'start': {'dateTime': start.isoformat()},
+            'end': {'dateTime': end.isoformat()},
+            'updated': datetime.now(timezone.utc).isoformat(),
+        }
+        with self._lock:
+            self.events.setdefault(calendarId, []).append(event)
+            self._log_change(calendarId, event)
+        return event
+
+    def request(self, uri, method='GET', body=None, headers=None, redirections=5, connection_type=None):
+        with self._lock:
+            self.stats['requests'] += 1
+        headers = {k.lower(): v for k, v in (headers or {}).items()}
+        path = urlparse(uri).path
+        if path.startswith('/batch'):
+            return self._batch(body, headers)
+        status, content = self._handle(method, uri, body)
+        return httplib2.Response({'status': str(status), 'content-type': 'application/json'}), content
+
+    def _handle(self, method: str, uri: str, body) -> tuple:
+        url = urlparse(uri)
+        match = EVENTS_PATH.search(url.path)
+        if match is None:
+            return 404, b'{"error": {"code": 404, "message": "Not Found"}}'
+        calendarId = unquote(match.group(1))
+        eventId = unquote(match.group(2)) if match.group(2) else None
+        if calendarId in self.failing:
+            return 500, b'{"error": {"code": 500, "message": "Backend Error"}}'
+        query = {k: v[0] for k, v in parse_qs(url.query).items()}
+        with self._lock:
+            if method == 'GET' and eventId is None:
+                return 200, json.dumps(self._list(calendarId, query)).encode()
+            if method == 'POST' and eventId is None:
+                if isinstance(body, bytes):
+                    body = body.decode()
+                event = json.loads(body)
+                event['id'] = uuid.uuid4().hex
+                event['updated'] = datetime.now(timezone.utc).isoformat()
+                self.events.setdefault(calendarId, []).append(event)
+                self._log_change(calendarId, event)
+                return 200, json.dumps(event).encode()
+            if method == 'DELETE' and eventId is not None:
+                events = self.events.get(calendarId, [])
+                for i, event in enumerate(events):
+                    if event['id'] == eventId:
+                        events.pop(i)
+                        self._log_change(calendarId, {'id': eventId, 'status': 'cancelled'})
+                        return 204, b''
+                return 404, b'{"error": {"code": 404, "message": "Not Found"}}'
+        return 400, b'{"error": {"code": 400, "message": "Bad Request"}}'
+
+    def _list(self, calendarId: str, query: dict) -> dict:
+        if 'syncToken' in query:
+            since = int(query['syncToken'])
+            latest = {}
+            for seq, cid, event in self._changes:
+                if seq > since and cid == calendarId:
+                    latest[event['id']] = event
+            return {'kind': 'calendar#events', 'items': list(latest.values()), 'nextSyncToken': str(self._seq)}
+        items = self.events.get(calendarId, [])
+        if 'timeMin' in query:
+            tmin = _parse_dt(query['timeMin'])
+            items = [e for e in items if _parse_dt(e['end']['dateTime']) > tmin]
+        if 'timeMax' in query:
+            tmax = _parse_dt(query['timeMax'])
+            items = [e for e in items if _parse_dt(e['start']['dateTime']) < tmax]
+        items = sorted(items, key=lambda e: _parse_dt(e['start']['dateTime']))
+        offset = int(query.get('pageToken', 0))
+        page = items[offset:offset + self.page_size]
+        result = {'kind': 'calendar#events', 'items': page}
+        if offset + self.page_size < len(items):
+            result['nextPageToken'] = str(offset + self.page_size)
+        else:
+            result['nextSyncToken'] = str(self._seq)
+        return result
+
+    def _batch(self, body, headers: dict) -> tuple:
+        if isinstance(body, str):
+            body = body.encode()
+        parser = email.parser.BytesFeedParser()
+        parser.feed(b'content-type: ' + headers['content-type'].encode() + b'\r\n\r\n' + body)
+        parts = parser.close().get_payload()
+        with self._lock:
+            self.stats['batches'] += 1
+            self.stats['batched_calls'] += len(parts)
+
+        boundary = 'batch_' + uuid.uuid4().hex
+        chunks = []
+        for part in parts:
+            content_id = part['Content-ID'].strip('<>')
+            request_text = part.get_payload()
+            head, sep, sub_body = request_text.partition('\r\n\r\n')
+            if not sep:
+                head, sep, sub_body = request_text.partition('\n\n')
+            method, path, _ = head.splitlines()[0].split(' ', 2)
+            status, content = self._handle(method, 'https://www.googleapis.com' + path, sub_body or None)
+            chunks.append(
+                f'--{boundary}\r\n'
+                f'Content-Type: application/http\r\n'
+                f'Content-ID: <response-{content_id}>\r\n\r\n'
+                f'HTTP/1.1 {status} {STATUS_TEXT.get(status, "")}\r\n'
+                f'Content-Type: application/json\r\n\r\n'
+                f'{content.decode()}\r\n'
+            )
+        chunks.append(f'--{boundary}--\r\n')
+        resp = httplib2.Response({'status': '200', 'content-type': f'multipart/mixed; boundary={boundary}'})
+        return resp, ''.join(chunks).encode()
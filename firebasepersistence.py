@@ -1,15 +1,60 @@
 import json
+import logging
 import os
+import threading
 from ast import literal_eval
 from collections import defaultdict
+from copy import deepcopy
 from typing import Dict
 
 import firebase_admin
 from firebase_admin import db
 from telegram.ext import BasePersistence
 
+from write_behind import WriteBehind
+
+logger = logging.getLogger(__name__)
+
+
+def _plain(value):
+    """value the way firebase hands it back: str keys, lists for tuples."""
+    if isinstance(value, dict):
+        return {str(k): _plain(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_plain(v) for v in value]
+    return value
+
+
+def _diff(path: str, old, new, out: dict) -> None:
+    """Adds the paths where new differs from old to out, None deleting a path."""
+    if isinstance(old, dict) and isinstance(new, dict):
+        changes = {}
+        for k, v in new.items():
+            if k not in old:
+                changes[f"{path}/{k}"] = v
+            elif old[k] != v:
+                _diff(f"{path}/{k}", old[k], v, changes)
+        for k in old:
+            if k not in new:
+                changes[f"{path}/{k}"] = None
+        # when most of it changed, send the node whole
+        if len(changes) > 1 and len(changes) >= len(new):
+            out[path] = new
+        else:
+            out.update(changes)
+    elif old != new:
+        out[path] = new
+
 
 class FirebasePersistence(BasePersistence):
+    """
+    Keeps a shadow copy of what is stored in firebase. Updates are diffed against it and
+    only the changed leaves are queued, by path; flush() sends everything queued as one
+    multi-path update(). Without write_delay every update_* call flushes straight away,
+    with it a background thread flushes once no change has come in for write_delay
+    seconds (at most max_write_delay after the first one), and at exit or on SIGTERM.
+    """
+
     def __init__(
         self,
         database_url: str,
@@ -17,9 +62,12 @@ class FirebasePersistence(BasePersistence):
         store_user_data=True,
         store_chat_data=True,
         store_bot_data=True,
+        write_delay: float = None,
+        max_write_delay: float = 2.0,
     ):
         cred = firebase_admin.credentials.Certificate(credentials)
         self.app = firebase_admin.initialize_app(cred, {"databaseURL": database_url})
+        self.fb_root = db.reference("/")
         self.fb_user_data = db.reference("user_data")
         self.fb_chat_data = db.reference("chat_data")
         self.fb_bot_data = db.reference("bot_data")
@@ -29,6 +77,17 @@ class FirebasePersistence(BasePersistence):
             store_chat_data=store_chat_data,
             store_bot_data=store_bot_data,
         )
+        # what firebase holds, as of the last get or update
+        self._shadow = {"user_data": {}, "chat_data": {}, "bot_data": {}}
+        # path -> value (None deletes) still to be sent
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self.write_delay = write_delay
+        self.max_write_delay = max_write_delay
+        self.stats = {"updates": 0, "writes": 0, "paths": 0, "failed": 0}
+        if write_delay is not None:
+            self._write_behind = WriteBehind(self.flush, write_delay, max_write_delay, "FirebasePersistence writer")
 
     @classmethod
     def from_environment(cls, **kwargs):
@@ -38,10 +97,9 @@ class FirebasePersistence(BasePersistence):
 
     def get_user_data(self):
         data = self.fb_user_data.get()
-        print(type(data))
         if data is None:
             data = {}
-        print(type(data))
+        self._shadow["user_data"] = _plain(data)
         output = self.convert_keys(data)
         return defaultdict(dict, output)
 
@@ -49,6 +107,7 @@ class FirebasePersistence(BasePersistence):
         data = self.fb_chat_data.get()
         if data is None:
             data = {}
+        self._shadow["chat_data"] = _plain(data)
         output = self.convert_keys(data)
         return defaultdict(dict, output)
 
@@ -56,6 +115,7 @@ class FirebasePersistence(BasePersistence):
         bot_data = self.fb_bot_data.get()
         if(bot_data is None):
             bot_data={}
+        self._shadow["bot_data"] = _plain(bot_data)
         return defaultdict(dict, bot_data)
 
     def get_conversations(self, name):
@@ -66,23 +126,95 @@ class FirebasePersistence(BasePersistence):
         return res
 
     def update_conversation(self, name, key, new_state):
-        if new_state:
-            self.fb_conversations.child(name).child(str(key)).set(new_state)
-        else:
-            self.fb_conversations.child(name).child(str(key)).delete()
+        with self._lock:
+            self._queue(f"conversations/{name}/{key}", _plain(new_state) if new_state else None)
+        self._request_flush()
 
     def update_user_data(self, user_id, data):
-        if not data:
-            return
-        self.fb_user_data.child(str(user_id)).update(data)
+        self._update("user_data", str(user_id), data)
 
     def update_chat_data(self, chat_id, data):
-        if not data:
-            return
-        self.fb_chat_data.child(str(chat_id)).update(data)
+        self._update("chat_data", str(chat_id), data)
 
     def update_bot_data(self, data):
-        self.fb_bot_data = data
+        self._update("bot_data", None, data)
+
+    def _update(self, section: str, key, data) -> None:
+        new = _plain(data)
+        changes = {}
+        with self._lock:
+            if key is None:
+                _diff(section, self._shadow[section], new, changes)
+                self._shadow[section] = new
+            else:
+                _diff(f"{section}/{key}", self._shadow[section].get(key, {}), new, changes)
+                self._shadow[section][key] = new
+            for path, value in changes.items():
+                self._queue(path, value)
+        if changes:
+            self._request_flush()
+
+    def _shadow_at(self, path: str, default=None):
+        """The shadow's value at path, or default outside the shadowed sections."""
+        section, *keys = path.split("/")
+        if section not in self._shadow:
+            return default
+        node = self._shadow[section]
+        for k in keys:
+            if not isinstance(node, dict) or k not in node:
+                return None
+            node = node[k]
+        return node
+
+    def _queue(self, path: str, value) -> None:
+        # firebase refuses an update() holding both a path and one of its ancestors
+        for queued in [q for q in self._pending if q.startswith(path + "/")]:
+            del self._pending[queued]
+        parts = path.split("/")
+        for i in range(1, len(parts)):
+            ancestor = "/".join(parts[:i])
+            if ancestor in self._pending:
+                # the shadow already has this change in it
+                self._pending[ancestor] = deepcopy(self._shadow_at(ancestor, self._pending[ancestor]))
+                return
+        self._pending[path] = value
+
+    def _request_flush(self) -> None:
+        self.stats["updates"] += 1
+        if self.write_delay is None:
+            self.flush()
+        else:
+            self._write_behind.changed()
+
+    def flush(self, timeout: float = -1) -> None:
+        if not self._flush_lock.acquire(timeout=timeout):
+            logger.warning("gave up waiting for the firebase update in progress")
+            return
+        try:
+            with self._lock:
+                pending, self._pending = self._pending, {}
+            if not pending:
+                return
+            try:
+                self.fb_root.update(pending)
+                self.stats["writes"] += 1
+                self.stats["paths"] += len(pending)
+            except Exception:
+                self.stats["failed"] += 1
+                with self._lock:
+                    # requeue what wasn't overtaken by newer changes, for the next flush
+                    for path, value in pending.items():
+                        if path not in self._pending:
+                            self._queue(path, deepcopy(self._shadow_at(path, value)))
+                raise
+        finally:
+            self._flush_lock.release()
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            stats = dict(self.stats)
+            stats["pending"] = len(self._pending)
+        return stats
 
     @staticmethod
     def convert_keys(data: Dict):
@@ -0,0 +1,72 @@
+'''
+Cache of rendered schedule images.
+
+Entries are keyed by the view (which image, for which day/week/room and
+backend) and remember a fingerprint of the events they were drawn from. A
+lookup only hits when the events behind the view still have the same
+fingerprint, so changes made outside the bot are picked up too; our own
+writes drop the entries of the calendar they touched straight away.
+'''
+import hashlib
+import threading
+from collections import OrderedDict
+
+
+def event_fingerprint(event_list: list) -> str:
+    '''Digest of the ids, rooms and last-updated times of the events behind an image.'''
+    h = hashlib.blake2b(digest_size=16)
+    for e in sorted(event_list, key=lambda e: (e.room, e.id)):
+        h.update(f'{e.room}\0{e.id}\0{e.updated}\n'.encode())
+    return h.hexdigest()
+
+
+class ImageCache:
+    '''Bounded LRU of rendered image bytes.'''
+
+    def __init__(self, maxsize: int = 64):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()   # key -> (fingerprint, calendarIds, image bytes)
+        self._lock = threading.Lock()
+        self.stats = {'hits': 0, 'misses': 0, 'stale': 0, 'evictions': 0, 'invalidations': 0}
+
+    def get(self, key: tuple, fingerprint: str):
+        '''The cached image bytes for key if they were drawn from the same events, otherwise None.'''
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.stats['misses'] += 1
+                return None
+            if entry[0] != fingerprint:
+                del self._entries[key]
+                self.stats['stale'] += 1
+                return None
+            self._entries.move_to_end(key)
+            self.stats['hits'] += 1
+            return entry[2]
+
+    def put(self, key: tuple, fingerprint: str, calendarIds: list, image: bytes) -> None:
+        with self._lock:
+            self._entries[key] = (fingerprint, frozenset(calendarIds), image)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.stats['evictions'] += 1
+
+    def invalidate(self, calendarId: str = None) -> int:
+        '''Drops the entries drawn from calendarId, or everything. Returns how many were dropped.'''
+        with self._lock:
+            if calendarId is None:
+                keys = list(self._entries)
+            else:
+                keys = [k for k, entry in self._entries.items() if calendarId in entry[1]]
+            for k in keys:
+                del self._entries[k]
+            self.stats['invalidations'] += len(keys)
+            return len(keys)
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            stats = dict(self.stats)
+            stats['entries'] = len(self._entries)
+            stats['bytes'] = sum(len(entry[2]) for entry in self._entries.values())
+            return stats
@@ -0,0 +1,141 @@
+'''
+Interval indexes used for booking conflict checks.
+
+IntervalIndex keeps intervals sorted by start time in small buckets, each of
+which knows the latest end among its intervals. An overlap query bisects for
+the buckets starting before the query ends and only looks inside those still
+running at its start, so one long interval costs a scan of its own bucket
+rather than of everything after it. BookingRequestIndex keeps one
+IntervalIndex per facility for the pending bot_data['booking_requests'].
+'''
+import bisect
+import threading
+from datetime import datetime
+
+# buckets are split when they grow past twice this
+BUCKET_SIZE = 64
+
+
+class IntervalIndex:
+    def __init__(self):
+        self._starts = []   # per bucket, the sorted starts of its intervals
+        self._items = []    # per bucket, (start, end, item) in the same order
+        self._firsts = []   # first start of each bucket
+        self._ends = []     # latest end of each bucket
+        self._len = 0
+
+    def __len__(self) -> int:
+        return self._len
+
+    def add(self, start: float, end: float, item) -> None:
+        self._len += 1
+        if not self._items:
+            self._starts.append([start])
+            self._items.append([(start, end, item)])
+            self._firsts.append(start)
+            self._ends.append(end)
+            return
+        b = max(bisect.bisect_right(self._firsts, start) - 1, 0)
+        starts, items = self._starts[b], self._items[b]
+        i = bisect.bisect_right(starts, start)
+        starts.insert(i, start)
+        items.insert(i, (start, end, item))
+        self._firsts[b] = starts[0]
+        self._ends[b] = max(self._ends[b], end)
+        if len(items) > 2*BUCKET_SIZE:
+            self._starts[b:b+1] = [starts[:BUCKET_SIZE], starts[BUCKET_SIZE:]]
+            self._items[b:b+1] = [items[:BUCKET_SIZE], items[BUCKET_SIZE:]]
+            self._firsts[b:b+1] = [starts[0], starts[BUCKET_SIZE]]
+            self._ends[b:b+1] = [max(e for _, e, _ in items[:BUCKET_SIZE]), max(e for _, e, _ in items[BUCKET_SIZE:])]
+
+    def remove(self, start: float, item) -> bool:
+        # intervals with the same start can straddle a bucket boundary
+        lo = max(bisect.bisect_left(self._firsts, start) - 1, 0)
+        hi = bisect.bisect_right(self._firsts, start)
+        for b in range(lo, hi):
+            starts, items = self._starts[b], self._items[b]
+            i = bisect.bisect_left(starts, start)
+            while i < len(starts) and starts[i] == start:
+                if items[i][2] is item or items[i][2] == item:
+                    del starts[i]
+                    del items[i]
+                    self._len -= 1
+                    if items:
+                        self._firsts[b] = starts[0]
+                        self._ends[b] = max(e for _, e, _ in items)
+                    else:
+                        del self._starts[b], self._items[b], self._firsts[b], self._ends[b]
+                    return True
+                i += 1
+        return False
+
+    def overlapping(self, start: float, end: float) -> list:
+        '''Items whose interval overlaps [start, end), ordered by start.'''
+        found = []
+        for b in range(bisect.bisect_left(self._firsts, end)):
+            # nothing in a bucket that ended by start can overlap
+            if self._ends[b] > start:
+                hi = bisect.bisect_left(self._starts[b], end)
+                found.extend(item for s, e, item in self._items[b][:hi] if e > start)
+        return found
+
+
+class BookingRequestIndex:
+    '''Per-facility index of pending booking requests.
+
+    The index follows the bot_data list it was built from. add() and remove()
+    keep it in step with the handlers' own changes, and it is rebuilt when the
+    list is replaced or changes size behind its back (e.g. after a reload).
+    '''
+    def __init__(self):
+        # hold it across an overlap check and the add() that depends on it
+        self.lock = threading.RLock()
+        self._source = None
+        self._size = 0
+        self._facilities = {}
+
+    @staticmethod
+    def _span(request: dict) -> tuple:
+        return datetime.fromisoformat(request['start']).timestamp(), datetime.fromisoformat(request['end']).timestamp()
+
+    def _index(self, facility: int) -> IntervalIndex:
+        if facility not in self._facilities:
+            self._facilities[facility] = IntervalIndex()
+        return self._facilities[facility]
+
+    def _sync(self, requests: list) -> None:
+        if requests is self._source and len(requests) == self._size:
+            return
+        self._facilities = {}
+        for request in requests:
+            start, end = self._span(request)
+            self._index(request['facility']).add(start, end, request)
+        self._source = requests
+        self._size = len(requests)
+
+    def add(self, requests: list, request: dict) -> None:
+        '''Call after appending request to requests.'''
+        with self.lock:
+            if requests is not self._source or len(requests) != self._size + 1:
+                self._source = None
+                self._sync(requests)
+                return
+            start, end = self._span(request)
+            self._index(request['facility']).add(start, end, request)
+            self._size += 1
+
+    def remove(self, requests: list, request: dict) -> None:
+        '''Call after removing request from requests.'''
+        with self.lock:
+            if requests is not self._source or len(requests) != self._size - 1:
+                self._source = None
+                self._sync(requests)
+                return
+            start, _ = self._span(request)
+            self._index(request['facility']).remove(start, request)
+            self._size -= 1
+
+    def overlapping(self, requests: list, facility: int, start: datetime, end: datetime) -> list:
+        with self.lock:
+            self._sync(requests)
+            return self._index(facility).overlapping(start.timestamp(), end.timestamp())
@@ -6,13 +6,14 @@
 Send /start to initiate the conversation.
 Press Ctrl-C on the command line to stop the bot.
 '''
+from startup_profile import StartupProfile
+startup = StartupProfile()  # start-up timings, logged with the first update answered
 import logging
-import dateparser
 from datetime import datetime, timedelta, timezone, tzinfo, time
 import html
 import json
 import traceback
-from requests import request
+from telegram.error import BadRequest, TelegramError
 from telegram import CallbackQuery, InlineKeyboardButton, InlineKeyboardMarkup, Update, ParseMode, ForceReply, Bot
 from telegram.ext import (
     Updater,
@@ -27,21 +28,18 @@ from telegram.ext import (
 from firebasepersistence import FirebasePersistence
 # from postgrespersistence import PostgresPersistence
 import re
+import sys
 import os
 import pytz
 import base64
-from calendar_generator import createImageAll, createImageDay, createImageWeek, get_calendar_service, get_event_list
-# stuff for google calendar api
-from os import path
-from google.auth.transport.requests import Request
-from google_auth_oauthlib.flow import InstalledAppFlow
-from oauth2client.service_account import ServiceAccountCredentials
-from googleapiclient.discovery import build
+from calendar_generator import createImageAll, createImageDay, createImageWeek, get_event_list, insert_event, delete_event, remember_file_id, RenderQueueFull, prerender, prerender_booking
+from interval_index import BookingRequestIndex
+from booking_dates import parse_date
 import os
-import http
 
 from flask import Flask, request
 from werkzeug.wrappers import Response
+startup.mark('imports')
 
 # PERMISSIONS FOR API ACCESS
 SCOPES = ['https://www.googleapis.com/auth/calendar.events', 'https://www.googleapis.com/auth/calendar']
@@ -73,8 +71,10 @@ tz = timezone(timedelta(hours=8))
 tz1 = pytz.timezone('Asia/Singapore')
 # for error logging
 PORT = int(os.environ.get('PORT', 5000))
+WEBHOOK_URL = os.environ.get('WEBHOOK_URL', 'https://msvsbookingbot-uubulot4qa-uc.a.run.app/')
 regexstring = '^(ME[1-8][AT]?|REC|PTE|LCP|CPL|CFC|SCT|OCT|([1-3]|[MS])SG|([1-3]|[MSC])WO|2LT|LTA|CPT|MAJ|LTC|SLTC|COL|BG|MG|LG|GEN) [a-zA-Z][a-zA-Z ]+$'
 rankname_validator = re.compile(regexstring)
+booking_request_index = BookingRequestIndex()   # pending bot_data['booking_requests'] by facility
 
 # GOOGLE CALENDAR API UTILITY FUNCTIONS
 # THIS ALLOWS US TO INTERACT WITH ALL GOOGLE APIS, IN THIS CASE CALENDAR
@@ -270,13 +270,18 @@ def approveHandler(update: Update, context: CallbackContext) -> int:
 # TODO APPROVE BOOKING BY ADMIN SYSTEM
 
 def insertEvent(booking, booking_facility):
-    service = get_calendar_service()
     cal_ids = json.loads(os.environ.get("CALENDAR_ID"))
     calendarId = cal_ids[booking_facility]
     
-    e = service.events().insert(calendarId=calendarId, body=booking).execute()
+    e = insert_event(calendarId, booking)
     return e
 
+def removeBookingRequest(context: CallbackContext, i: int) -> dict:
+    with booking_request_index.lock:
+        request = context.bot_data['booking_requests'].pop(i)
+        booking_request_index.remove(context.bot_data['booking_requests'], request)
+    return request
+
 def approveBooking(update: Update, context: CallbackContext) -> int:
     userid = str(update.effective_user.id)
     if('users' in context.bot_data):
@@ -352,7 +357,8 @@ def approveBookingHandler(update: Update, context: CallbackContext) -> int:
     dt = sdt.strftime('%d/%m %H%M')+'-'+edt.strftime('%H%M')
     cal_ids = json.loads(os.environ.get("CALENDAR_ID"))
     calendarId = cal_ids[facility]
-    event_list = get_event_list([calendarId], sdt, edt)
+    # synced first: a mirror even seconds old could let two approvals book the same slot
+    event_list = get_event_list([calendarId], sdt, edt, max_age=0, records=True)
     nameunit = rn + ' ' + un
     booking = {
         'summary': nameunit,
@@ -366,7 +372,7 @@ def approveBookingHandler(update: Update, context: CallbackContext) -> int:
     
     if event_list:  # duplicate event
         booked = event_list[0]
-        if booked==booking:
+        if booked.summary==nameunit and booked.start==sdt and booked.end==edt:
             #duplicate event
             bot.send_message(
                 chat_id=update.effective_chat.id,
@@ -380,7 +386,7 @@ def approveBookingHandler(update: Update, context: CallbackContext) -> int:
                 chat_id=int(user),
                 text=f'Your booking has been denied as the selected timeslot is no longer available. Please book another timeslot.')
         
-        context.bot_data['booking_requests'].pop(int(req[0]))
+        removeBookingRequest(context, int(req[0]))
         return ConversationHandler.END
     
     if not req[1]:
@@ -391,10 +397,10 @@ def approveBookingHandler(update: Update, context: CallbackContext) -> int:
         bot.send_message(
             chat_id=int(user),
             text=f'Your booking has been denied')
-        context.bot_data['booking_requests'].pop(int(req[0]))
+        removeBookingRequest(context, int(req[0]))
         return ConversationHandler.END
     
-    context.bot_data['booking_requests'].pop(int(req[0]))
+    removeBookingRequest(context, int(req[0]))
     e=insertEvent(booking,facility)    
     logger.info('Event created: %s' % (e.get('htmlLink')))
     bot.edit_message_text(
@@ -404,6 +410,7 @@ def approveBookingHandler(update: Update, context: CallbackContext) -> int:
     bot.send_message(
             chat_id=int(user),
             text=f'Your booking has been approved!')
+    prerender_booking(facility, sdt)
     context.user_data.clear()
     return ConversationHandler.END
 
@@ -600,7 +607,7 @@ def date(update: Update, context: CallbackContext) -> int:
 
 def time1(update: Update, context: CallbackContext) -> int:
     booking_date = update.message.text 
-    bd = dateparser.parse(booking_date, settings={'DATE_ORDER': 'DMY'})
+    bd = parse_date(booking_date)
     logger.info(f'BD0={bd}')
     bot = context.bot
     if(bd is None or (bd.date()<(datetime.now().date()))):
@@ -627,13 +634,13 @@ def time1(update: Update, context: CallbackContext) -> int:
     
     daystart_dt = bd
     dayend_dt = (bd+timedelta(days=1))
-    event_list = get_event_list([calendarId], daystart_dt, dayend_dt)
+    event_list = get_event_list([calendarId], daystart_dt, dayend_dt, records=True)
     if not event_list:
         booklist+='None\n'
     for e in event_list:
-        start_t = dateparser.parse(e['start']['dateTime']).astimezone(tz).strftime('%H%M')
-        end_t = dateparser.parse(e['end']['dateTime']).astimezone(tz).strftime('%H%M')
-        name = e['summary']
+        start_t = e.start.astimezone(tz).strftime('%H%M')
+        end_t = e.end.astimezone(tz).strftime('%H%M')
+        name = e.summary
         booklist+=f'{name} [{start_t}-{end_t}]\n'
     context.user_data['msgid']=bot.send_message(
         chat_id=update.effective_chat.id, 
@@ -708,16 +715,29 @@ def bookHandler(update: Update, context: CallbackContext) -> int:
         )
         return TIME
     
-    if('booking_requests' not in context.bot_data.keys()):
-        context.bot_data['booking_requests']=[]
-    context.bot_data['booking_requests'].append({
-        'rankname':rankname,
-        'unit':unit,
-        'user':userid,
-        'start':start_dt.isoformat(),
-        'end':end_dt.isoformat(),
-        'facility':booking_facility
-    })
+    # checked and added under one lock, so two requests for the same slot can't both get in
+    with booking_request_index.lock:
+        if('booking_requests' not in context.bot_data.keys()):
+            context.bot_data['booking_requests']=[]
+        pending = booking_request_index.overlapping(context.bot_data['booking_requests'], booking_facility, start_dt, end_dt)
+        if not pending:
+            booking_request = {
+                'rankname':rankname,
+                'unit':unit,
+                'user':userid,
+                'start':start_dt.isoformat(),
+                'end':end_dt.isoformat(),
+                'facility':booking_facility
+            }
+            context.bot_data['booking_requests'].append(booking_request)
+            booking_request_index.add(context.bot_data['booking_requests'], booking_request)
+    if pending:
+        requested = pending[0]['rankname'] + ' ' + pending[0]['unit']
+        bot.edit_message_text(
+            chat_id=update.effective_chat.id, message_id=context.user_data['msgid'], 
+            text=f'Cannot book {ROOMS[booking_facility]} on {bd_str} {booking_time}. Booking already requested by {requested} and pending approval. Use /cancel to cancel or enter your booking start and end time in 24 hour HHHH-HHHH format.'
+        )
+        return TIME
     for user in context.bot_data['users'].keys():
         if(context.bot_data['users'][user]['admin']):
             bot.send_message(chat_id=int(user), text=f'{rankname}, {unit} has requested to book {ROOMS[booking_facility]} on {bd_str} at {booking_time}. Approve bookings with /approve_booking')   
@@ -782,16 +802,29 @@ def bookTrackHandler(update: Update, context: CallbackContext) -> int:
             text=f'Cannot book {ROOMS[booking_facility]} on {bd_str} {booking_time}. Booking already made by {booked}. Use /cancel to cancel or enter your booking start and end time in 24 hour HHHH-HHHH format.'
         )
         return TIME
-    if('booking_requests' not in context.bot_data.keys()):
-        context.bot_data['booking_requests']=[]
-    context.bot_data['booking_requests'].append({
-        'rankname':rankname,
-        'unit':unit,
-        'user':userid,
-        'start':start_dt.isoformat(),
-        'end':end_dt.isoformat(),
-        'facility':booking_facility
-    })
+    # checked and added under one lock, so two requests for the same slot can't both get in
+    with booking_request_index.lock:
+        if('booking_requests' not in context.bot_data.keys()):
+            context.bot_data['booking_requests']=[]
+        pending = booking_request_index.overlapping(context.bot_data['booking_requests'], booking_facility, start_dt, end_dt)
+        if not pending:
+            booking_request = {
+                'rankname':rankname,
+                'unit':unit,
+                'user':userid,
+                'start':start_dt.isoformat(),
+                'end':end_dt.isoformat(),
+                'facility':booking_facility
+            }
+            context.bot_data['booking_requests'].append(booking_request)
+            booking_request_index.add(context.bot_data['booking_requests'], booking_request)
+    if pending:
+        requested = pending[0]['rankname'] + ' ' + pending[0]['unit']
+        bot.edit_message_text(
+            chat_id=update.effective_chat.id, message_id=context.user_data['msgid'], 
+            text=f'Cannot book {ROOMS[booking_facility]} on {bd_str} {booking_time}. Booking already requested by {requested} and pending approval. Use /cancel to cancel or enter your booking start and end time in 24 hour HHHH-HHHH format.'
+        )
+        return TIME
     for user in context.bot_data['users'].keys():
         if(context.bot_data['users'][user]['admin']):
             bot.send_message(chat_id=int(user), text=f'{rankname}, {unit} has requested to book {ROOMS[booking_facility]} on {bd_str} at {booking_time}. Approve bookings with /approve_booking')   
@@ -824,7 +857,7 @@ def delete(update: Update, context: CallbackContext) -> int:   # Registration st
 
 def bookingDelete(update: Update, context: CallbackContext) -> int:
     booking_date = update.message.text 
-    bd = dateparser.parse(booking_date, settings={'DATE_ORDER': 'DMY'})
+    bd = parse_date(booking_date)
     bot = context.bot
     if(bd is None or (bd.date()<(datetime.now().date()))):
         try:
@@ -847,14 +880,14 @@ def bookingDelete(update: Update, context: CallbackContext) -> int:
     
     daystart_dt = bd.astimezone(tz)
     dayend_dt = (bd+timedelta(days=1)).astimezone(tz)
-    event_list = get_event_list([calendarId], daystart_dt, dayend_dt)
+    event_list = get_event_list([calendarId], daystart_dt, dayend_dt, records=True)
     keyboard = []
     valid = False
     for e in event_list:
-        start_t = dateparser.parse(e['start']['dateTime']).astimezone(tz).strftime('%H%M')
-        end_t = dateparser.parse(e['end']['dateTime']).astimezone(tz).strftime('%H%M')
-        name = e['summary']
-        id = e['id']
+        start_t = e.start.astimezone(tz).strftime('%H%M')
+        end_t = e.end.astimezone(tz).strftime('%H%M')
+        name = e.summary
+        id = e.id
         if(name==nameunit):
             valid = True
             keyboard.append([InlineKeyboardButton(f'[{start_t}-{end_t}]', callback_data=id)])
@@ -879,20 +912,66 @@ def deleteHandler(update: Update, context: CallbackContext) -> int:
     query = update.callback_query
     booking_to_delete = query.data
     query.answer()
-    service = get_calendar_service()
     bot = context.bot
     logger.info(f'removing booking for id {booking_to_delete}')
     cal_ids = json.loads(os.environ.get("CALENDAR_ID"))
     booking_facility = int(context.user_data['facility'])
     calendarId = cal_ids[booking_facility]
-    service.events().delete(calendarId=calendarId, eventId=booking_to_delete).execute()
+    delete_event(calendarId, booking_to_delete)
     bot.edit_message_text(
         chat_id=update.effective_chat.id, 
         message_id=context.user_data['msgid'], 
         text=f'Booking deleted.'
     ).message_id
+    prerender_booking(booking_facility, datetime.strptime(context.user_data['booking_date'], '%d/%m/%Y').replace(tzinfo=tz))
     return ConversationHandler.END
 
+def sendSchedule(update: Update, context: CallbackContext, create, *args) -> None:
+    '''Replies "Rendering..." and sends create(*args) in its place once it is ready.
+
+    This runs inside the webhook request: the dispatcher has no worker threads
+    here and the instance gets no CPU once the response is sent. The image cache
+    and the reused file_ids keep it short.
+    '''
+    placeholder = context.bot.send_message(chat_id=update.effective_chat.id, text='Rendering...')
+    deliverSchedule(context, update.effective_chat.id, placeholder.message_id, create, args)
+
+def deliverSchedule(context: CallbackContext, chat_id: int, placeholder_id: int, create, args: tuple) -> None:
+    '''Sends create(*args) in place of the placeholder, or an apology if that fails.'''
+    try:
+        sendImage(context, chat_id, placeholder_id, create, args)
+    except Exception:
+        logger.exception('could not send a schedule image')
+        try:
+            context.bot.edit_message_text(chat_id=chat_id, message_id=placeholder_id, text='Sorry, the schedule could not be drawn. Please try again.')
+        except TelegramError:
+            pass
+
+def sendImage(context: CallbackContext, chat_id: int, placeholder_id: int, create, args: tuple) -> None:
+    '''Sends create(*args), reusing the telegram file_id of an identical image sent before.'''
+    bot = context.bot
+    # kept in bot_data so they survive restarts
+    if 'image_file_ids' not in context.bot_data:
+        context.bot_data['image_file_ids'] = {}
+    file_ids = context.bot_data['image_file_ids']
+    try:
+        img = create(*args, file_ids=file_ids)
+    except RenderQueueFull:
+        logger.warning('render queue full, turning away a view request')
+        bot.edit_message_text(chat_id=chat_id, message_id=placeholder_id, text='The bot is busy drawing schedules, please try again in a minute.')
+        return
+    try:
+        msg = bot.send_photo(chat_id=chat_id, photo=img)
+    except BadRequest:
+        if not isinstance(img, str):
+            raise
+        # telegram no longer has the file, upload it again
+        logger.info(f'stale file_id {img}, uploading the image again')
+        img = create(*args)
+        msg = bot.send_photo(chat_id=chat_id, photo=img)
+    remember_file_id(file_ids, img, msg.photo[-1].file_id)
+    bot.delete_message(chat_id=chat_id, message_id=placeholder_id)
+
 def viewDay(update: Update, context: CallbackContext) -> int:   # view start point
     user = update.effective_user
     if('users' in context.bot_data):
@@ -906,8 +985,7 @@ def viewDay(update: Update, context: CallbackContext) -> int:   # view start poi
 
 def viewDayHandler(update: Update, context: CallbackContext) -> int:
     booking_date = update.message.text 
-    bd = dateparser.parse(booking_date, settings={'DATE_ORDER': 'DMY'})
-    bd = datetime.combine(bd.date(), datetime.min.time(), tzinfo=tz)
+    bd = parse_date(booking_date)
     bot = context.bot
     if(bd is None or (bd.date()<(datetime.now().date()))):
         try:
@@ -921,9 +999,9 @@ def viewDayHandler(update: Update, context: CallbackContext) -> int:
                 text=f'Incorrect format. Please enter a valid booking date.'
             )
         return DATE
-    img = createImageDay(bd)
+    bd = datetime.combine(bd.date(), datetime.min.time(), tzinfo=tz)
     logger.info(f'generating image for {booking_date}')
-    bot.send_photo(chat_id=update.effective_chat.id, photo=img)
+    sendSchedule(update, context, createImageDay, bd)
     return ConversationHandler.END
 
 def viewWeek(update: Update, context: CallbackContext) -> int:   # Registration start point
@@ -946,14 +1024,11 @@ def viewWeekHandler(update: Update, context: CallbackContext) -> int:
     query = update.callback_query
     room = int(query.data)
     query.answer()
-    bot = context.bot
-    img = createImageWeek(room)
     logger.info(f'generating image for {ROOMS[room]}')
-    bot.send_photo(chat_id=update.effective_chat.id, photo=img)
+    sendSchedule(update, context, createImageWeek, room)
     return ConversationHandler.END
     
 def view(update: Update, context: CallbackContext) -> int:
-    bot = context.bot
     user = update.effective_user
     if('users' in context.bot_data):
         if(str(user.id) not in context.bot_data['users']): # user not registered
@@ -963,10 +1038,9 @@ def view(update: Update, context: CallbackContext) -> int:
     now = None
     if(args is not None):
         argstr = ' '.join(args)
-        now = dateparser.parse(argstr, settings={'DATE_ORDER': 'DMY'})
-    img = createImageAll(now)
+        now = parse_date(argstr)
     logger.info(f'generating overview image')
-    bot.send_photo(chat_id=update.effective_chat.id, photo=img)
+    sendSchedule(update, context, createImageAll, now)
 
 def reminder(context: CallbackContext) -> int:
     bot = context.bot
@@ -1014,6 +1088,20 @@ def error_handler(update: object, context: CallbackContext) -> None:
     context.bot.send_message(chat_id=int(DEVELOPER_CHAT_ID), text=message, parse_mode=ParseMode.HTML)
     context.bot.send_message(chat_id=update.effective_chat.id, text='An error has occurred. Please use /cancel to cancel this action.')
 
+def setWebhook(bot: Bot, url: str) -> None:
+    '''Registers url with telegram, unless telegram already has it.
+
+    Not done on import, which would cost every cold start a round trip to
+    telegram. Run `python main.py set-webhook` when deploying, or POST to
+    /<token>/set_webhook, and again after polling (msvsbot.py,
+    send_scheduled.py) has deleted the webhook.
+    '''
+    if bot.get_webhook_info().url == url:
+        logger.info('webhook unchanged, not registering it again')
+        return
+    bot.set_webhook(url)
+    logger.info('webhook registered')
+
 def init_testing_deploy():
     keys_64 = os.environ['keys']
     keys = base64.b64decode(keys_64).decode()
@@ -1055,6 +1143,7 @@ app = Flask(__name__)
 # Create the Updater and pass it your bot's token.
 init_testing_deploy()
 # init_testing_deploy()
+startup.mark('keys')
 
 TOKEN = os.environ.get('TELE_BOT_TOKEN')
 # N = 'msvs-bot'
@@ -1066,11 +1155,11 @@ if('postgresql' not in DATABASE_URL):
 pers = PostgresPersistence(url=DATABASE_URL)
 with open('firebasecred.json') as credfile:
     cred = json.load(credfile)'''
-pers = FirebasePersistence().from_environment()
+pers = FirebasePersistence.from_environment(write_delay=0.2)
 # updater = Updater(TOKEN, persistence=pers)
 bot = Bot(token=TOKEN)
-bot.set_webhook("https://msvsbookingbot-uubulot4qa-uc.a.run.app/"+TOKEN)
 dispatcher = Dispatcher(bot=bot, update_queue=None, persistence=pers)
+startup.mark('persistence')
 # Get the dispatcher to register handlers
 # dispatcher = updater.dispatcher
 # Setup conversation for registration
@@ -1235,6 +1324,7 @@ dispatcher.add_handler(CommandHandler('cancel', cancelReg))
 # dispatcher.add_handler(CommandHandler('create_cals', create_cals))
 #Errors
 dispatcher.add_error_handler(error_handler)
+startup.mark('handlers')
 
 # Start the Bot
 
@@ -1264,4 +1354,31 @@ def webhook():
     update = Update.de_json(request.get_json(), bot)
     # process update
     dispatcher.process_update(update)
-    return "ok"
\ No newline at end of file
+    # write this update's changes before answering, the instance may be frozen afterwards
+    try:
+        pers.flush()
+    except Exception:
+        # the changes stay queued for the next flush; a 500 would make telegram
+        # deliver the update again and every handler would run twice
+        logger.exception('could not write the persistence data')
+    startup.first_response()
+    return "ok"
+
+@app.route(f'/{TOKEN}/set_webhook', methods=['POST'])
+def setWebhookView():
+    """registers this deployment's webhook with telegram"""
+    setWebhook(bot, WEBHOOK_URL+TOKEN)
+    return "ok"
+
+# called by Cloud Scheduler; drawing here rather than on a timer in the process,
+# which would get no CPU between requests
+@app.route(f'/{TOKEN}/prerender', methods=['POST'])
+def prerenderView():
+    """draws the common /view images into the image cache"""
+    prerender()
+    return "ok"
+
+if __name__ == '__main__':
+    if sys.argv[1:] == ['set-webhook']:
+        # deploy step, see setWebhook
+        setWebhook(bot, WEBHOOK_URL+TOKEN)
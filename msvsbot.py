@@ -7,12 +7,11 @@ Send /start to initiate the conversation.
 Press Ctrl-C on the command line to stop the bot.
 '''
 import logging
-import dateparser
 from datetime import datetime, timedelta, timezone, tzinfo, time
 import html
 import json
 import traceback
-from requests import request
+from telegram.error import BadRequest, TelegramError
 from telegram import CallbackQuery, InlineKeyboardButton, InlineKeyboardMarkup, Update, ParseMode, ForceReply
 from telegram.ext import (
     Updater,
@@ -29,13 +28,9 @@ import re
 import os
 import pytz
 import base64
-from calendar_generator import createImageAll, createImageDay, createImageWeek, get_calendar_service, get_event_list
-# stuff for google calendar api
-from os import path
-from google.auth.transport.requests import Request
-from google_auth_oauthlib.flow import InstalledAppFlow
-from oauth2client.service_account import ServiceAccountCredentials
-from googleapiclient.discovery import build
+from calendar_generator import createImageAll, createImageDay, createImageWeek, get_event_list, insert_event, delete_event, remember_file_id, RenderQueueFull, prerender
+from interval_index import BookingRequestIndex
+from booking_dates import parse_date
 
 # PERMISSIONS FOR API ACCESS
 SCOPES = ['https://www.googleapis.com/auth/calendar.events', 'https://www.googleapis.com/auth/calendar']
@@ -65,8 +60,10 @@ tz = timezone(timedelta(hours=8))
 tz1 = pytz.timezone('Asia/Singapore')
 # for error logging
 PORT = int(os.environ.get('PORT', 5000))
+PRERENDER_INTERVAL = int(os.environ.get('PRERENDER_INTERVAL', 600))  # seconds between scheduled prerenders
 regexstring = '^(ME[1-8][AT]?|REC|PTE|LCP|CPL|CFC|SCT|OCT|([1-3]|[MS])SG|([1-3]|[MSC])WO|2LT|LTA|CPT|MAJ|LTC|SLTC|COL|BG|MG|LG|GEN) [a-zA-Z][a-zA-Z ]+$'
 rankname_validator = re.compile(regexstring)
+booking_request_index = BookingRequestIndex()   # pending bot_data['booking_requests'] by facility
 
 # GOOGLE CALENDAR API UTILITY FUNCTIONS
 # THIS ALLOWS US TO INTERACT WITH ALL GOOGLE APIS, IN THIS CASE CALENDAR
@@ -262,13 +259,18 @@ def approveHandler(update: Update, context: CallbackContext) -> int:
 # TODO APPROVE BOOKING BY ADMIN SYSTEM
 
 def insertEvent(booking, booking_facility):
-    service = get_calendar_service()
     cal_ids = json.loads(os.environ.get("CALENDAR_ID"))
     calendarId = cal_ids[booking_facility]
     
-    e = service.events().insert(calendarId=calendarId, body=booking).execute()
+    e = insert_event(calendarId, booking)
     return e
 
+def removeBookingRequest(context: CallbackContext, i: int) -> dict:
+    with booking_request_index.lock:
+        request = context.bot_data['booking_requests'].pop(i)
+        booking_request_index.remove(context.bot_data['booking_requests'], request)
+    return request
+
 def approveBooking(update: Update, context: CallbackContext) -> int:
     userid = str(update.effective_user.id)
     if('users' in context.bot_data):
@@ -344,7 +346,8 @@ def approveBookingHandler(update: Update, context: CallbackContext) -> int:
     dt = sdt.strftime('%d/%m %H%M')+'-'+edt.strftime('%H%M')
     cal_ids = json.loads(os.environ.get("CALENDAR_ID"))
     calendarId = cal_ids[facility]
-    event_list = get_event_list([calendarId], sdt, edt)
+    # synced first: a mirror even seconds old could let two approvals book the same slot
+    event_list = get_event_list([calendarId], sdt, edt, max_age=0, records=True)
     nameunit = rn + ' ' + un
     booking = {
         'summary': nameunit,
@@ -358,7 +361,7 @@ def approveBookingHandler(update: Update, context: CallbackContext) -> int:
     
     if event_list:  # duplicate event
         booked = event_list[0]
-        if booked==booking:
+        if booked.summary==nameunit and booked.start==sdt and booked.end==edt:
             #duplicate event
             bot.send_message(
                 chat_id=update.effective_chat.id,
@@ -372,7 +375,7 @@ def approveBookingHandler(update: Update, context: CallbackContext) -> int:
                 chat_id=int(user),
                 text=f'Your booking has been denied as the selected timeslot is no longer available. Please book another timeslot.')
         
-        context.bot_data['booking_requests'].pop(int(req[0]))
+        removeBookingRequest(context, int(req[0]))
         return ConversationHandler.END
     
     if not req[1]:
@@ -383,12 +386,13 @@ def approveBookingHandler(update: Update, context: CallbackContext) -> int:
         bot.send_message(
             chat_id=int(user),
             text=f'Your booking has been denied')
-        context.bot_data['booking_requests'].pop(int(req[0]))
+        removeBookingRequest(context, int(req[0]))
         return ConversationHandler.END
     
-    context.bot_data['booking_requests'].pop(int(req[0]))
+    removeBookingRequest(context, int(req[0]))
     e=insertEvent(booking,facility)    
     logger.info('Event created: %s' % (e.get('htmlLink')))
+    schedulePrerender(context)
     bot.edit_message_text(
             chat_id=update.effective_chat.id,
             message_id = context.user_data['msgid'],
@@ -592,7 +596,7 @@ def date(update: Update, context: CallbackContext) -> int:
 
 def time1(update: Update, context: CallbackContext) -> int:
     booking_date = update.message.text 
-    bd = dateparser.parse(booking_date, settings={'DATE_ORDER': 'DMY'})
+    bd = parse_date(booking_date)
     logger.info(f'BD0={bd}')
     bot = context.bot
     if(bd is None or (bd.date()<(datetime.now().date()))):
@@ -619,13 +623,13 @@ def time1(update: Update, context: CallbackContext) -> int:
     
     daystart_dt = bd
     dayend_dt = (bd+timedelta(days=1))
-    event_list = get_event_list([calendarId], daystart_dt, dayend_dt)
+    event_list = get_event_list([calendarId], daystart_dt, dayend_dt, records=True)
     if not event_list:
         booklist+='None\n'
     for e in event_list:
-        start_t = dateparser.parse(e['start']['dateTime']).astimezone(tz).strftime('%H%M')
-        end_t = dateparser.parse(e['end']['dateTime']).astimezone(tz).strftime('%H%M')
-        name = e['summary']
+        start_t = e.start.astimezone(tz).strftime('%H%M')
+        end_t = e.end.astimezone(tz).strftime('%H%M')
+        name = e.summary
         booklist+=f'{name} [{start_t}-{end_t}]\n'
     context.user_data['msgid']=bot.send_message(
         chat_id=update.effective_chat.id, 
@@ -700,16 +704,29 @@ def bookHandler(update: Update, context: CallbackContext) -> int:
         )
         return TIME
     
-    if('booking_requests' not in context.bot_data.keys()):
-        context.bot_data['booking_requests']=[]
-    context.bot_data['booking_requests'].append({
-        'rankname':rankname,
-        'unit':unit,
-        'user':userid,
-        'start':start_dt.isoformat(),
-        'end':end_dt.isoformat(),
-        'facility':booking_facility
-    })
+    # checked and added under one lock, so two requests for the same slot can't both get in
+    with booking_request_index.lock:
+        if('booking_requests' not in context.bot_data.keys()):
+            context.bot_data['booking_requests']=[]
+        pending = booking_request_index.overlapping(context.bot_data['booking_requests'], booking_facility, start_dt, end_dt)
+        if not pending:
+            booking_request = {
+                'rankname':rankname,
+                'unit':unit,
+                'user':userid,
+                'start':start_dt.isoformat(),
+                'end':end_dt.isoformat(),
+                'facility':booking_facility
+            }
+            context.bot_data['booking_requests'].append(booking_request)
+            booking_request_index.add(context.bot_data['booking_requests'], booking_request)
+    if pending:
+        requested = pending[0]['rankname'] + ' ' + pending[0]['unit']
+        bot.edit_message_text(
+            chat_id=update.effective_chat.id, message_id=context.user_data['msgid'], 
+            text=f'Cannot book {ROOMS[booking_facility]} on {bd_str} {booking_time}. Booking already requested by {requested} and pending approval. Use /cancel to cancel or enter your booking start and end time in 24 hour HHHH-HHHH format.'
+        )
+        return TIME
     for user in context.bot_data['users'].keys():
         if(context.bot_data['users'][user]['admin']):
             bot.send_message(chat_id=int(user), text=f'{rankname}, {unit} has requested to book {ROOMS[booking_facility]} on {bd_str} at {booking_time}. Approve bookings with /approve_booking')   
@@ -774,16 +791,29 @@ def bookTrackHandler(update: Update, context: CallbackContext) -> int:
             text=f'Cannot book {ROOMS[booking_facility]} on {bd_str} {booking_time}. Booking already made by {booked}. Use /cancel to cancel or enter your booking start and end time in 24 hour HHHH-HHHH format.'
         )
         return TIME
-    if('booking_requests' not in context.bot_data.keys()):
-        context.bot_data['booking_requests']=[]
-    context.bot_data['booking_requests'].append({
-        'rankname':rankname,
-        'unit':unit,
-        'user':userid,
-        'start':start_dt.isoformat(),
-        'end':end_dt.isoformat(),
-        'facility':booking_facility
-    })
+    # checked and added under one lock, so two requests for the same slot can't both get in
+    with booking_request_index.lock:
+        if('booking_requests' not in context.bot_data.keys()):
+            context.bot_data['booking_requests']=[]
+        pending = booking_request_index.overlapping(context.bot_data['booking_requests'], booking_facility, start_dt, end_dt)
+        if not pending:
+            booking_request = {
+                'rankname':rankname,
+                'unit':unit,
+                'user':userid,
+                'start':start_dt.isoformat(),
+                'end':end_dt.isoformat(),
+                'facility':booking_facility
+            }
+            context.bot_data['booking_requests'].append(booking_request)
+            booking_request_index.add(context.bot_data['booking_requests'], booking_request)
+    if pending:
+        requested = pending[0]['rankname'] + ' ' + pending[0]['unit']
+        bot.edit_message_text(
+            chat_id=update.effective_chat.id, message_id=context.user_data['msgid'], 
+            text=f'Cannot book {ROOMS[booking_facility]} on {bd_str} {booking_time}. Booking already requested by {requested} and pending approval. Use /cancel to cancel or enter your booking start and end time in 24 hour HHHH-HHHH format.'
+        )
+        return TIME
     for user in context.bot_data['users'].keys():
         if(context.bot_data['users'][user]['admin']):
             bot.send_message(chat_id=int(user), text=f'{rankname}, {unit} has requested to book {ROOMS[booking_facility]} on {bd_str} at {booking_time}. Approve bookings with /approve_booking')   
@@ -816,7 +846,7 @@ def delete(update: Update, context: CallbackContext) -> int:   # Registration st
 
 def bookingDelete(update: Update, context: CallbackContext) -> int:
     booking_date = update.message.text 
-    bd = dateparser.parse(booking_date, settings={'DATE_ORDER': 'DMY'})
+    bd = parse_date(booking_date)
     bot = context.bot
     if(bd is None or (bd.date()<(datetime.now().date()))):
         try:
@@ -839,14 +869,14 @@ def bookingDelete(update: Update, context: CallbackContext) -> int:
     
     daystart_dt = bd.astimezone(tz)
     dayend_dt = (bd+timedelta(days=1)).astimezone(tz)
-    event_list = get_event_list([calendarId], daystart_dt, dayend_dt)
+    event_list = get_event_list([calendarId], daystart_dt, dayend_dt, records=True)
     keyboard = []
     valid = False
     for e in event_list:
-        start_t = dateparser.parse(e['start']['dateTime']).astimezone(tz).strftime('%H%M')
-        end_t = dateparser.parse(e['end']['dateTime']).astimezone(tz).strftime('%H%M')
-        name = e['summary']
-        id = e['id']
+        start_t = e.start.astimezone(tz).strftime('%H%M')
+        end_t = e.end.astimezone(tz).strftime('%H%M')
+        name = e.summary
+        id = e.id
         if(name==nameunit):
             valid = True
             keyboard.append([InlineKeyboardButton(f'[{start_t}-{end_t}]', callback_data=id)])
@@ -871,13 +901,13 @@ def deleteHandler(update: Update, context: CallbackContext) -> int:
     query = update.callback_query
     booking_to_delete = query.data
     query.answer()
-    service = get_calendar_service()
     bot = context.bot
     logger.info(f'removing booking for id {booking_to_delete}')
     cal_ids = json.loads(os.environ.get("CALENDAR_ID"))
     booking_facility = int(context.user_data['facility'])
     calendarId = cal_ids[booking_facility]
-    service.events().delete(calendarId=calendarId, eventId=booking_to_delete).execute()
+    delete_event(calendarId, booking_to_delete)
+    schedulePrerender(context)
     bot.edit_message_text(
         chat_id=update.effective_chat.id, 
         message_id=context.user_data['msgid'], 
@@ -885,6 +915,61 @@ def deleteHandler(update: Update, context: CallbackContext) -> int:
     ).message_id
     return ConversationHandler.END
 
+def prerenderJob(context: CallbackContext) -> None:
+    prerender()
+
+def schedulePrerender(context: CallbackContext) -> None:
+    '''Redraws the common views after a booking change, unless a redraw is already waiting.'''
+    if context.job_queue is None:
+        return
+    if not context.job_queue.get_jobs_by_name('prerender_now'):
+        context.job_queue.run_once(prerenderJob, 0, name='prerender_now')
+
+def sendSchedule(update: Update, context: CallbackContext, create, *args) -> None:
+    '''Replies "Rendering..." and sends create(*args) in its place once it is ready.
+
+    The image is made on the async workers the updater starts (and drawn on the
+    render processes), so the handler returns straight away.
+    '''
+    placeholder = context.bot.send_message(chat_id=update.effective_chat.id, text='Rendering...')
+    context.dispatcher.run_async(deliverSchedule, context, update.effective_chat.id, placeholder.message_id, create, args, update=update)
+
+def deliverSchedule(context: CallbackContext, chat_id: int, placeholder_id: int, create, args: tuple) -> None:
+    '''Sends create(*args) in place of the placeholder, or an apology if that fails.'''
+    try:
+        sendImage(context, chat_id, placeholder_id, create, args)
+    except Exception:
+        logger.exception('could not send a schedule image')
+        try:
+            context.bot.edit_message_text(chat_id=chat_id, message_id=placeholder_id, text='Sorry, the schedule could not be drawn. Please try again.')
+        except TelegramError:
+            pass
+
+def sendImage(context: CallbackContext, chat_id: int, placeholder_id: int, create, args: tuple) -> None:
+    '''Sends create(*args), reusing the telegram file_id of an identical image sent before.'''
+    bot = context.bot
+    # kept in bot_data so they survive restarts
+    if 'image_file_ids' not in context.bot_data:
+        context.bot_data['image_file_ids'] = {}
+    file_ids = context.bot_data['image_file_ids']
+    try:
+        img = create(*args, file_ids=file_ids)
+    except RenderQueueFull:
+        logger.warning('render queue full, turning away a view request')
+        bot.edit_message_text(chat_id=chat_id, message_id=placeholder_id, text='The bot is busy drawing schedules, please try again in a minute.')
+        return
+    try:
+        msg = bot.send_photo(chat_id=chat_id, photo=img)
+    except BadRequest:
+        if not isinstance(img, str):
+            raise
+        # telegram no longer has the file, upload it again
+        logger.info(f'stale file_id {img}, uploading the image again')
+        img = create(*args)
+        msg = bot.send_photo(chat_id=chat_id, photo=img)
+    remember_file_id(file_ids, img, msg.photo[-1].file_id)
+    bot.delete_message(chat_id=chat_id, message_id=placeholder_id)
+
 def viewDay(update: Update, context: CallbackContext) -> int:   # view start point
     user = update.effective_user
     if('users' in context.bot_data):
@@ -898,8 +983,7 @@ def viewDay(update: Update, context: CallbackContext) -> int:   # view start poi
 
 def viewDayHandler(update: Update, context: CallbackContext) -> int:
     booking_date = update.message.text 
-    bd = dateparser.parse(booking_date, settings={'DATE_ORDER': 'DMY'})
-    bd = datetime.combine(bd.date(), datetime.min.time(), tzinfo=tz)
+    bd = parse_date(booking_date)
     bot = context.bot
     if(bd is None or (bd.date()<(datetime.now().date()))):
         try:
@@ -913,9 +997,9 @@ def viewDayHandler(update: Update, context: CallbackContext) -> int:
                 text=f'Incorrect format. Please enter a valid booking date.'
             )
         return DATE
-    img = createImageDay(bd)
+    bd = datetime.combine(bd.date(), datetime.min.time(), tzinfo=tz)
     logger.info(f'generating image for {booking_date}')
-    bot.send_photo(chat_id=update.effective_chat.id, photo=img)
+    sendSchedule(update, context, createImageDay, bd)
     return ConversationHandler.END
 
 def viewWeek(update: Update, context: CallbackContext) -> int:   # Registration start point
@@ -938,14 +1022,11 @@ def viewWeekHandler(update: Update, context: CallbackContext) -> int:
     query = update.callback_query
     room = int(query.data)
     query.answer()
-    bot = context.bot
-    img = createImageWeek(room)
     logger.info(f'generating image for {ROOMS[room]}')
-    bot.send_photo(chat_id=update.effective_chat.id, photo=img)
+    sendSchedule(update, context, createImageWeek, room)
     return ConversationHandler.END
     
 def view(update: Update, context: CallbackContext) -> int:
-    bot = context.bot
     user = update.effective_user
     if('users' in context.bot_data):
         if(str(user.id) not in context.bot_data['users']): # user not registered
@@ -955,10 +1036,9 @@ def view(update: Update, context: CallbackContext) -> int:
     now = None
     if(args is not None):
         argstr = ' '.join(args)
-        now = dateparser.parse(argstr, settings={'DATE_ORDER': 'DMY'})
-    img = createImageAll(now)
+        now = parse_date(argstr)
     logger.info(f'generating overview image')
-    bot.send_photo(chat_id=update.effective_chat.id, photo=img)
+    sendSchedule(update, context, createImageAll, now)
 
 def reminder(context: CallbackContext) -> int:
     bot = context.bot
@@ -1197,6 +1277,8 @@ def main() -> None:
     # dispatcher.add_handler(CommandHandler('create_cals', create_cals))
     #Errors
     dispatcher.add_error_handler(error_handler)
+    # keep the common views drawn ahead of time
+    updater.job_queue.run_repeating(prerenderJob, interval=PRERENDER_INTERVAL, first=0, name='prerender')
 
     # Start the Bot
     
@@ -0,0 +1,108 @@
+'''
+httplib2-compatible transport for the google calendar client.
+
+httplib2.Http is not thread safe and does not pool connections, so the
+calendar service is built on top of PooledHttp instead. Requests go through a
+single requests.Session with a bounded keep-alive pool per host, which can be
+shared by all the webhook threads.
+'''
+import logging
+import threading
+
+import httplib2
+import requests
+from requests.adapters import HTTPAdapter
+from google.auth.transport.requests import Request
+
+logger = logging.getLogger(__name__)
+
+REFRESH_STATUS_CODES = (401,)
+
+
+class PooledHttp:
+    def __init__(self, credentials, pool_maxsize: int = 8, pool_connections: int = 4, timeout: float = 30):
+        self.credentials = credentials
+        self.pool_maxsize = pool_maxsize
+        self.timeout = timeout
+        self.session = requests.Session()
+        # pool_block makes threads wait for a free connection instead of opening extra ones
+        self.adapter = HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize, pool_block=True)
+        self.session.mount('https://', self.adapter)
+        self.session.mount('http://', self.adapter)
+        self._auth_request = Request(self.session)
+        self._token_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self.stats = {
+            'requests': 0,
+            'in_flight': 0,
+            'max_in_flight': 0,
+            'saturated': 0,
+            'token_refreshes': 0,
+        }
+
+    def _apply_credentials(self, headers: dict, force_refresh: bool = False) -> None:
+        if self.credentials is None:
+            return
+        with self._token_lock:
+            if force_refresh or not self.credentials.valid:
+                self.credentials.refresh(self._auth_request)
+                with self._stats_lock:
+                    self.stats['token_refreshes'] += 1
+            self.credentials.apply(headers)
+
+    def request(self, uri, method='GET', body=None, headers=None, redirections=5, connection_type=None):
+        headers = dict(headers or {})
+        with self._stats_lock:
+            self.stats['requests'] += 1
+            if self.stats['in_flight'] >= self.pool_maxsize:
+                self.stats['saturated'] += 1
+            self.stats['in_flight'] += 1
+            self.stats['max_in_flight'] = max(self.stats['max_in_flight'], self.stats['in_flight'])
+        try:
+            self._apply_credentials(headers)
+            resp = self._send(uri, method, body, headers, redirections)
+            if resp.status_code in REFRESH_STATUS_CODES and self.credentials is not None:
+                logger.info('calendar request unauthorized, refreshing token')
+                self._apply_credentials(headers, force_refresh=True)
+                resp = self._send(uri, method, body, headers, redirections)
+        finally:
+            with self._stats_lock:
+                self.stats['in_flight'] -= 1
+        info = {k.lower(): v for k, v in resp.headers.items()}
+        # requests already decoded the body
+        info.pop('content-encoding', None)
+        info['status'] = str(resp.status_code)
+        return httplib2.Response(info), resp.content
+
+    def _send(self, uri, method, body, headers, redirections):
+        return self.session.request(
+            method,
+            uri,
+            data=body,
+            headers=headers,
+            timeout=self.timeout,
+            allow_redirects=redirections > 0,
+        )
+
+    def get_stats(self) -> dict:
+        '''Request counters plus connection reuse numbers from the urllib3 pools.'''
+        with self._stats_lock:
+            stats = dict(self.stats)
+        connections = 0
+        pooled_requests = 0
+        free_slots = 0
+        pools = self.adapter.poolmanager.pools
+        for key in list(pools.keys()):
+            pool = pools.get(key)
+            if pool is None:
+                continue
+            connections += pool.num_connections
+            pooled_requests += pool.num_requests
+            free_slots += pool.pool.qsize() if pool.pool is not None else 0
+        stats['connections_opened'] = connections
+        stats['connections_reused'] = max(pooled_requests - connections, 0)
+        stats['free_slots'] = free_slots
+        return stats
+
+    def close(self) -> None:
+        self.session.close()
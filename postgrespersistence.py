@@ -19,29 +19,180 @@
 """This module contains PostgresqlPersistence class"""
 
 
+import select
+import time
+import uuid
+from hashlib import blake2b
 from logging import getLogger
-from collections import defaultdict
-from typing import Dict, Tuple, Any, Callable, Optional
+from collections import Counter, defaultdict
+from copy import deepcopy
+from threading import Lock, Thread
+from typing import Dict, List, Tuple, Any, Callable, Optional, Union
 
 from telegram.ext import DictPersistence
-from telegram.utils.helpers import (
-    encode_conversations_to_json,
-    decode_conversations_from_json,
-)
+from telegram.utils.helpers import decode_conversations_from_json
 
-from sqlalchemy import create_engine
-from sqlalchemy.sql import text
+from sqlalchemy import create_engine, inspect
+from sqlalchemy.sql import bindparam, text
 from sqlalchemy.orm import sessionmaker, scoped_session
 
+from write_behind import WriteBehind
+
 try:
     import ujson as json
 except ImportError:
     import json  # type: ignore[no-redef]
 
 
+# One row per user, per chat, per top-level bot_data key and per conversation key.
+TABLES = (
+    """CREATE TABLE IF NOT EXISTS persistence_user_data(
+        user_id BIGINT PRIMARY KEY,
+        data jsonb NOT NULL,
+        version BIGINT NOT NULL DEFAULT 1);""",
+    """CREATE TABLE IF NOT EXISTS persistence_chat_data(
+        chat_id BIGINT PRIMARY KEY,
+        data jsonb NOT NULL,
+        version BIGINT NOT NULL DEFAULT 1);""",
+    """CREATE TABLE IF NOT EXISTS persistence_bot_data(
+        key TEXT PRIMARY KEY,
+        data jsonb NOT NULL,
+        version BIGINT NOT NULL DEFAULT 1);""",
+    """CREATE TABLE IF NOT EXISTS persistence_conversations(
+        name TEXT NOT NULL,
+        key TEXT NOT NULL,
+        state jsonb NOT NULL,
+        PRIMARY KEY (name, key));""",
+)
+
+UPSERT = {
+    "user_data": """INSERT INTO persistence_user_data (user_id, data) VALUES (:key, :data)
+        ON CONFLICT (user_id) DO UPDATE SET data = EXCLUDED.data""",
+    "chat_data": """INSERT INTO persistence_chat_data (chat_id, data) VALUES (:key, :data)
+        ON CONFLICT (chat_id) DO UPDATE SET data = EXCLUDED.data""",
+    "bot_data": """INSERT INTO persistence_bot_data (key, data) VALUES (:key, :data)
+        ON CONFLICT (key) DO UPDATE SET data = EXCLUDED.data""",
+    "conversations": """INSERT INTO persistence_conversations (name, key, state) VALUES (:name, :key, :data)
+        ON CONFLICT (name, key) DO UPDATE SET state = EXCLUDED.state""",
+}
+
+DELETE = {
+    "bot_data": "DELETE FROM persistence_bot_data WHERE key = :key",
+    "conversations": "DELETE FROM persistence_conversations WHERE name = :name AND key = :key",
+}
+
+# Rows of user_data, chat_data and bot_data carry a version that every write bumps. A write
+# only goes through if the version is still the one last seen, and affects no row otherwise.
+INSERT = {
+    "user_data": """INSERT INTO persistence_user_data (user_id, data) VALUES (:key, :data)
+        ON CONFLICT (user_id) DO NOTHING""",
+    "chat_data": """INSERT INTO persistence_chat_data (chat_id, data) VALUES (:key, :data)
+        ON CONFLICT (chat_id) DO NOTHING""",
+    "bot_data": """INSERT INTO persistence_bot_data (key, data) VALUES (:key, :data)
+        ON CONFLICT (key) DO NOTHING""",
+}
+
+PATCH = {
+    "user_data": """UPDATE persistence_user_data SET data = {}, version = version + 1
+        WHERE user_id = :key AND version = :version""",
+    "chat_data": """UPDATE persistence_chat_data SET data = {}, version = version + 1
+        WHERE chat_id = :key AND version = :version""",
+    "bot_data": """UPDATE persistence_bot_data SET data = {}, version = version + 1
+        WHERE key = :key AND version = :version""",
+}
+
+SELECT_ROW = {
+    "user_data": "SELECT CAST(data AS TEXT), version FROM persistence_user_data WHERE user_id = :key",
+    "chat_data": "SELECT CAST(data AS TEXT), version FROM persistence_chat_data WHERE chat_id = :key",
+    "bot_data": "SELECT CAST(data AS TEXT), version FROM persistence_bot_data WHERE key = :key",
+}
+
+SELECT_ALL = {
+    "user_data": "SELECT user_id, CAST(data AS TEXT), version FROM persistence_user_data",
+    "chat_data": "SELECT chat_id, CAST(data AS TEXT), version FROM persistence_chat_data",
+    "bot_data": "SELECT key, CAST(data AS TEXT), version FROM persistence_bot_data",
+}
+
+SELECT_ROWS = {
+    "user_data": f"{SELECT_ALL['user_data']} WHERE user_id IN :keys",
+    "chat_data": f"{SELECT_ALL['chat_data']} WHERE chat_id IN :keys",
+    "bot_data": f"{SELECT_ALL['bot_data']} WHERE key IN :keys",
+}
+
+# how many times a row is merged and written again before the write is given up on
+CONFLICT_RETRIES = 3
+
+# every write is announced on this channel with the rows it wrote
+CHANNEL = "persistence"
+# NOTIFY payloads must stay under 8000 bytes
+NOTIFY_LIMIT = 7900
+
+_MISSING = object()
+
+
+def _dump_row(value: Any) -> Tuple[str, Optional[Union[Dict[str, str], List[str]]]]:
+    """The row as json and, when it is a dict, the json of each of its values by key, or when
+    it is a list, the json of each of its elements."""
+    if isinstance(value, list):
+        parts = [json.dumps(v) for v in value]
+        return "[" + ",".join(parts) + "]", parts
+    if not isinstance(value, dict):
+        return json.dumps(value), None
+    parts = {str(k): json.dumps(v) for k, v in value.items()}
+    return "{" + ",".join(f"{json.dumps(k)}:{v}" for k, v in parts.items()) + "}", parts
+
+
+def _query_bytes(rows: list) -> int:
+    """Size of the queries and parameters sent for ``(query, params, ...)`` rows."""
+    return sum(len(qry) + sum(len(str(v)) for v in params.values()) for qry, params, *_ in rows)
+
+
+def _digest(value: str) -> bytes:
+    return blake2b(value.encode(), digest_size=8).digest()
+
+
+def _fingerprint(
+    dumped: str, parts: Optional[Union[Dict[str, str], List[str]]]
+) -> Tuple[bytes, Optional[Union[Dict[str, bytes], Tuple[bytes, ...]]]]:
+    """Digests of a dumped row and of each of its keys, or of each of its elements."""
+    if parts is None:
+        return _digest(dumped), None
+    if isinstance(parts, list):
+        return _digest(dumped), tuple(_digest(v) for v in parts)
+    return _digest(dumped), {k: _digest(v) for k, v in parts.items()}
+
+
 class PostgresPersistence(DictPersistence):
     """Using Postgresql database to make user/chat/bot data persistent across reboots.
 
+    Every user, chat, top-level bot_data key and conversation key is a row of its own,
+    and only the rows that changed since the last write are upserted, so the cost of a
+    write follows the size of the change rather than the size of the database. Data
+    saved by older versions in the single-row ``persistence`` table is imported the
+    first time the new tables are found empty; the old table is left in place.
+
+    A fingerprint of every row, and of every key inside rows that are dicts, is kept
+    from the last write. Rows that come out the same are not written at all, and on
+    PostgreSQL a row with only a few changed keys is patched with ``jsonb_set`` instead
+    of being sent whole.
+
+    Several processes can share the database. Each user, chat and bot_data row has a
+    version, and a write only applies if nobody else wrote the row since it was read.
+    When someone did, the row is read again and merged key by key: keys this process
+    changed keep its values, every other key takes the stored one. Rows that are lists
+    get the elements this process added and removed applied to the stored list. The merged data is
+    handed back to the dispatcher through the ``refresh_*`` methods, so a process that
+    approved one user doesn't drop the approval another one just wrote.
+
+    On PostgreSQL every write is announced with ``NOTIFY``, listing the rows it wrote, and
+    a background connection ``LISTEN``\ s for the announcements of the other processes and
+    reloads just those rows. They reach the dispatcher the same way merged rows do.
+
+    With ``write_delay`` set, updates only mark rows as changed and a background thread
+    writes them in one transaction once no further change has come in for ``write_delay``
+    seconds, or at the latest ``max_write_delay`` seconds after the first one. Pending
+    changes are written on :meth:`flush`, on SIGTERM and at interpreter exit.
+
     Attributes:
         store_user_data (:obj:`bool`): Whether user_data should be saved by this
             persistence class.
@@ -55,6 +206,13 @@ class PostgresPersistence(DictPersistence):
         session (:obj:`scoped_session`, Optional): sqlalchemy scoped session.
         on_flush (:obj:`bool`, optional): if set to :obj:`True` :class:`PostgresPersistence`
             will only update bot/chat/user data when :meth:flush is called.
+        write_delay (:obj:`float`, optional): seconds to wait for further changes before
+            writing them from a background thread. Defaults to :obj:`None`, which writes
+            every change straight away.
+        max_write_delay (:obj:`float`, optional): the longest a change waits for the
+            background thread, in seconds. Defaults to 2.
+        listen (:obj:`bool`, optional): whether to reload the rows other processes write
+            as they announce them. Only used on PostgreSQL. Defaults to :obj:`True`.
         **kwargs (:obj:`dict`): Arbitrary keyword Arguments to be passed to
             the DictPersistence constructor.
     """
@@ -64,6 +222,9 @@ class PostgresPersistence(DictPersistence):
         url: str = None,
         session: scoped_session = None,
         on_flush: bool = False,
+        write_delay: float = None,
+        max_write_delay: float = 2.0,
+        listen: bool = True,
         **kwargs: Any,
     ) -> None:
 
@@ -85,39 +246,106 @@ class PostgresPersistence(DictPersistence):
         super().__init__(**kwargs)
 
         self.on_flush = on_flush
+        self.write_delay = write_delay
+        self.max_write_delay = max_write_delay
+        self.stats = {
+            "updates": 0, "unchanged": 0, "skipped": 0, "writes": 0, "rows": 0, "bytes": 0, "failed": 0,
+            "conflicts": 0, "notified": 0, "reloaded": 0,
+        }
+        # (row digest, {key: digest} or None) of each row as it was last written
+        self._fingerprints = {"user_data": {}, "chat_data": {}, "bot_data": {}}
+        # row versions as last read or written
+        self._versions = {"user_data": {}, "chat_data": {}, "bot_data": {}}
+        # rows changed by another process and not yet handed to the dispatcher, with the
+        # fingerprint of what the dispatcher still holds (None if it has no such row)
+        self._refresh = {"user_data": {}, "chat_data": {}, "bot_data": {}}
+        self._partial_updates = self._session.get_bind().dialect.name == "postgresql"
+        self._notify = self._session.get_bind().dialect.name == "postgresql"
+        self._instance = uuid.uuid4().hex
+        # rows changed since the last successful write, per table
+        self._dirty = {"user_data": set(), "chat_data": set(), "bot_data": set(), "conversations": set()}
+        self._dirty_lock = Lock()
+        self._write_lock = Lock()
+        # held while a row the dispatcher updates is replaced, so a merge or reload on the
+        # writer thread can't overwrite an update that came in meanwhile
+        self._data_lock = Lock()
         self.__init_database()
         self.__load_database()
 
+        if write_delay is not None and not on_flush:
+            self._write_behind = WriteBehind(
+                self._update_database, write_delay, max_write_delay, "PostgresPersistence writer"
+            )
+        if listen and self._notify:
+            Thread(target=self._listen, name="PostgresPersistence listener", daemon=True).start()
+
     def __init_database(self) -> None:
         """
-        creates table for storing the data if table
-        doesn't exist already inside database.
+        creates the tables for storing the data if they
+        don't exist already inside database, and imports
+        the data of the old single-row table into them.
         """
-        create_table_qry = """
-            CREATE TABLE IF NOT EXISTS persistence(
-            data json NOT NULL);"""
-        self._session.execute(text(create_table_qry))
+        try:
+            for create_table_qry in TABLES:
+                self._session.execute(text(create_table_qry))
+            self._session.commit()
+            self.__migrate_blob()
+        finally:
+            self._session.close()
+
+    def __migrate_blob(self) -> None:
+        if not inspect(self._session.get_bind()).has_table("persistence"):
+            return
+        for table in ("user_data", "chat_data", "bot_data", "conversations"):
+            if self._session.execute(text(f"SELECT 1 FROM persistence_{table} LIMIT 1")).first():
+                return
+        data_ = self._session.execute(text("SELECT CAST(data AS TEXT) FROM persistence")).first()
+        data = json.loads(data_[0]) if data_ is not None else {}
+        if not data:
+            return
+
+        self.logger.info("Importing data from the persistence table....")
+        rows = []
+        for user_id, user_data in data.get("user_data", {}).items():
+            rows.append((UPSERT["user_data"], {"key": int(user_id), "data": json.dumps(user_data)}))
+        for chat_id, chat_data in data.get("chat_data", {}).items():
+            rows.append((UPSERT["chat_data"], {"key": int(chat_id), "data": json.dumps(chat_data)}))
+        for key, value in (data.get("bot_data") or {}).items():
+            rows.append((UPSERT["bot_data"], {"key": key, "data": json.dumps(value)}))
+        conversations = decode_conversations_from_json(data.get("conversations", "{}"))
+        for name, states in conversations.items():
+            for key, state in states.items():
+                if state is not None:
+                    rows.append(
+                        (UPSERT["conversations"], {"name": name, "key": json.dumps(key), "data": json.dumps(state)})
+                    )
+        for qry, params in rows:
+            self._session.execute(text(qry), params)
         self._session.commit()
+        self.logger.info("Imported %d rows from the persistence table.", len(rows))
 
     def __load_database(self) -> None:
         try:
-            data_ = self._session.execute(text("SELECT data FROM persistence")).first()
-            data = data_[0] if data_ is not None else {}
-
             self.logger.info("Loading database....")
-            self._chat_data = defaultdict(dict, self._key_mapper(data.get("chat_data", {}), int))
-            self._user_data = defaultdict(dict, self._key_mapper(data.get("user_data", {}), int))
-            self._bot_data = data.get("bot_data", {})
-            self._conversations = decode_conversations_from_json(data.get("conversations", "{}"))
+            user_rows = self._session.execute(text(SELECT_ALL["user_data"])).all()
+            self._user_data = defaultdict(dict, {int(k): json.loads(v) for k, v, _ in user_rows})
+            self._versions["user_data"] = {int(k): version for k, _, version in user_rows}
+            chat_rows = self._session.execute(text(SELECT_ALL["chat_data"])).all()
+            self._chat_data = defaultdict(dict, {int(k): json.loads(v) for k, v, _ in chat_rows})
+            self._versions["chat_data"] = {int(k): version for k, _, version in chat_rows}
+            bot_rows = self._session.execute(text(SELECT_ALL["bot_data"])).all()
+            self._bot_data = {k: json.loads(v) for k, v, _ in bot_rows}
+            self._versions["bot_data"] = {k: version for k, _, version in bot_rows}
+            # a handful of large rows; user and chat rows are fingerprinted just before their
+            # first update replaces them instead, which keeps start-up fast with many users
+            self._fingerprints["bot_data"] = {k: _fingerprint(*_dump_row(v)) for k, v in self._bot_data.items()}
+            conversation_rows = self._session.execute(
+                text("SELECT name, key, CAST(state AS TEXT) FROM persistence_conversations")
+            )
+            self._conversations = {}
+            for name, key, state in conversation_rows:
+                self._conversations.setdefault(name, {})[tuple(json.loads(key))] = json.loads(state)
             self.logger.info("Database loaded successfully!")
-
-            # if it is a fresh setup we'll add some placeholder data so we
-            # can perform `UPDATE` opearations on it, cause SQL only allows
-            # `UPDATE` operations if column have some data already present inside it.
-            if not data:
-                insert_qry = "INSERT INTO persistence (data) VALUES (:jsondata)"
-                self._session.execute(text(insert_qry), {"jsondata": "{}"})
-                self._session.commit()
         finally:
             self._session.close()
 
@@ -125,31 +353,302 @@ class PostgresPersistence(DictPersistence):
     def _key_mapper(iterable: Dict, func: Callable) -> Dict:
         return {func(k): v for k, v in iterable.items()}
 
-    def _dump_into_json(self) -> Any:
-        """Dumps data into json format for inserting in db."""
+    def _mark_dirty(self, table: str, *keys: Any) -> None:
+        with self._dirty_lock:
+            self._dirty[table].update(keys)
 
-        to_dump = {
-            "chat_data": self._chat_data,
-            "user_data": self._user_data,
-            "bot_data": self.bot_data,
-            "conversations": encode_conversations_to_json(self._conversations),
-        }
-        self.logger.debug("Dumping %s", to_dump)
-        return json.dumps(to_dump)
+    def _changed_rows(self, table: str, *keys: Any) -> None:
+        """Marks rows changed by an update and writes them, now or from the writer thread."""
+        with self._dirty_lock:
+            self._dirty[table].update(keys)
+            self.stats["updates"] += 1
+        if self.on_flush:
+            return
+        if self.write_delay is None:
+            self._update_database()
+        else:
+            self._write_behind.changed()
+
+    def get_stats(self) -> Dict:
+        """Update and write counts; ``writes_avoided`` is how many updates were folded into
+        another update's write."""
+        with self._dirty_lock:
+            stats = dict(self.stats)
+            stats["pending"] = sum(len(keys) for keys in self._dirty.values())
+        stats["writes_avoided"] = max(stats["updates"] - stats["writes"] - stats["failed"], 0)
+        return stats
+
+    def _keep_base(self, table: str, key: Any) -> None:
+        """Fingerprints a stored row that isn't yet, before an update replaces what was read."""
+        if key in self._versions[table] and key not in self._fingerprints[table]:
+            self._fingerprints[table][key] = _fingerprint(*_dump_row(self._table_data(table)[key]))
+
+    def _table_data(self, table: str) -> Dict:
+        return {"user_data": self._user_data, "chat_data": self._chat_data, "bot_data": self._bot_data}[table]
+
+    def _row_write(self, table: str, key: Any, value: Any, written: Dict) -> Optional[Tuple]:
+        """The ``(query, params, table, key)`` writing one row, or :obj:`None` when the row is
+        unchanged since it was last written. ``written`` collects the row's new fingerprint and
+        version."""
+        dumped, parts = _dump_row(value)
+        fingerprint = _fingerprint(dumped, parts)
+        old = self._fingerprints[table].get(key)
+        if old is not None and old[0] == fingerprint[0]:
+            self.stats["skipped"] += 1
+            return None
+        version = self._versions[table].get(key)
+        written[(table, key)] = (fingerprint, (version or 0) + 1)
+        if version is None:
+            return INSERT[table], {"key": key, "data": dumped}, table, key
+        whole = (PATCH[table].format(":data"), {"key": key, "data": dumped, "version": version}, table, key)
+        if not self._partial_updates or old is None or not isinstance(old[1], dict) or not isinstance(parts, dict):
+            return whole
+        expr = "data"
+        params = {"key": key, "version": version}
+        for i, k in enumerate(k for k in old[1] if k not in parts):
+            expr = f"({expr} - CAST(:r{i} AS text))"
+            params[f"r{i}"] = k
+        for i, k in enumerate(k for k, digest in fingerprint[1].items() if old[1].get(k) != digest):
+            expr = f"jsonb_set({expr}, ARRAY[CAST(:p{i} AS text)], CAST(:v{i} AS jsonb))"
+            params[f"p{i}"] = k
+            params[f"v{i}"] = parts[k]
+        patch = (PATCH[table].format(expr), params, table, key)
+        # small rows, or rows where most keys changed, are cheaper to send whole
+        return min(whole, patch, key=lambda row: _query_bytes([row]))
 
-    def _update_database(self) -> None:
-        self.logger.debug("Updating database...")
+    @staticmethod
+    def _merge(base: Optional[Tuple], ours: Any, theirs: Any) -> Any:
+        """Three-way merge of a row, :obj:`_MISSING` standing for no row. ``base`` is the
+        fingerprint of what ours was derived from, :obj:`None` if there was no row. If ours is
+        still the same theirs wins, otherwise dicts are merged key by key the same way, lists
+        get our additions and removals applied to theirs and anything else takes ours."""
+        our_print = None if ours is _MISSING else _fingerprint(*_dump_row(ours))
+        if (None if our_print is None else our_print[0]) == (None if base is None else base[0]):
+            return theirs
+        if isinstance(ours, list) and isinstance(theirs, list):
+            base_items = Counter(base[1] if base is not None and isinstance(base[1], tuple) else ())
+            our_items = Counter(our_print[1])
+            removed = base_items - our_items
+            # the first occurrences of what the base held are ours to keep, the rest we added
+            kept = base_items & our_items
+            merged = []
+            for item in theirs:
+                digest = _digest(json.dumps(item))
+                if removed[digest]:
+                    removed[digest] -= 1
+                else:
+                    merged.append(item)
+            for item, digest in zip(ours, our_print[1]):
+                if kept[digest]:
+                    kept[digest] -= 1
+                else:
+                    merged.append(item)
+            return merged
+        if not isinstance(ours, dict) or not isinstance(theirs, dict):
+            return ours
+        base_keys = base[1] if base is not None and isinstance(base[1], dict) else {}
+        ours = {str(k): v for k, v in ours.items()}
+        merged = {}
+        for k in list(ours) + [k for k in theirs if k not in ours]:
+            changed = base_keys.get(k) != our_print[1].get(k)
+            source = ours if changed else theirs
+            if k in source:
+                merged[k] = source[k]
+        return merged
+
+    def _merge_row(self, table: str, key: Any, written: Dict) -> None:
+        """Writes a row that somebody else wrote since we read it, merged with theirs."""
+        for _ in range(CONFLICT_RETRIES):
+            self.stats["conflicts"] += 1
+            stored = self._session.execute(text(SELECT_ROW[table]), {"key": key}).first()
+            with self._data_lock:
+                data = self._table_data(table)
+                ours = data[key]
+                if stored is None:
+                    merged, version = ours, None
+                    qry, params = INSERT[table], {"key": key}
+                else:
+                    merged = self._merge(self._fingerprints[table].get(key), ours, json.loads(stored[0]))
+                    version = stored[1]
+                    qry, params = PATCH[table].format(":data"), {"key": key, "version": version}
+                dumped, parts = _dump_row(merged)
+                params["data"] = dumped
+                if self._session.execute(text(qry), params).rowcount:
+                    data[key] = merged
+                    written[(table, key)] = (_fingerprint(dumped, parts), (version or 0) + 1)
+                    if merged != ours:
+                        with self._dirty_lock:
+                            self._refresh[table].setdefault(key, _fingerprint(*_dump_row(ours)))
+                    return
+        raise RuntimeError(f"{table} row {key!r} kept changing while it was being merged")
+
+    def _catch_up(self, table: str, key: Any, value: Any) -> Any:
+        """The dispatcher's value of a row, merged with changes it hasn't been handed yet."""
+        with self._dirty_lock:
+            base = self._refresh[table].get(key, _MISSING)
+        if base is _MISSING:
+            return value
+        return self._merge(base, value, self._table_data(table).get(key, _MISSING))
+
+    def _notify_payload(self, written: Dict) -> str:
+        rows = {}
+        for table, key in written:
+            rows.setdefault(table, []).append(key)
+        payload = json.dumps({"from": self._instance, "rows": rows})
+        if len(payload) > NOTIFY_LIMIT:
+            # too many to list, the other processes reload the whole tables
+            payload = json.dumps({"from": self._instance, "rows": {table: None for table in rows}})
+        return payload
+
+    def _listen(self) -> None:
+        """Reloads the rows other processes announce they wrote."""
+        reconnected = False
+        while True:
+            raw = None
+            try:
+                raw = self._session.get_bind().raw_connection()
+                connection = raw.dbapi_connection
+                connection.autocommit = True
+                connection.cursor().execute(f"LISTEN {CHANNEL}")
+                if reconnected:
+                    # whatever was announced while we weren't listening is lost
+                    for table in self._versions:
+                        self._reload(table, None)
+                reconnected = True
+                while True:
+                    if select.select([connection], [], [], 60) == ([], [], []):
+                        continue
+                    connection.poll()
+                    while connection.notifies:
+                        self._on_notify(connection.notifies.pop(0).payload)
+            except Exception as excp:  # pylint: disable=W0703
+                self.logger.error(
+                    "Lost the connection listening for changes, reconnecting.\nLogging exception: ",
+                    exc_info=excp,
+                )
+                if raw is not None:
+                    raw.invalidate()
+                time.sleep(5)
+
+    def _on_notify(self, payload: str) -> None:
+        message = json.loads(payload)
+        if message["from"] == self._instance:
+            return
+        self.stats["notified"] += 1
+        for table, keys in message["rows"].items():
+            self._reload(table, keys)
+
+    def _reload(self, table: str, keys: Optional[list]) -> None:
+        """Reads the rows of ``table`` in ``keys`` (all of them if :obj:`None`) that another
+        process wrote, to be handed to the dispatcher with its next update."""
         try:
-            insert_qry = "UPDATE persistence SET data = :jsondata"
-            params = {"jsondata": self._dump_into_json()}
-            self._session.execute(text(insert_qry), params)
-            self._session.commit()
-        except Exception as excp:  # pylint: disable=W0703
+            if keys is None:
+                stored = self._session.execute(text(SELECT_ALL[table])).all()
+            else:
+                qry = text(SELECT_ROWS[table]).bindparams(bindparam("keys", expanding=True))
+                stored = self._session.execute(qry, {"keys": keys}).all()
+        finally:
             self._session.close()
-            self.logger.error(
-                "Failed to save data in the database.\nLogging exception: ",
-                exc_info=excp,
-            )
+        found = {k: (v, version) for k, v, version in stored}
+        # only bot_data rows are ever deleted
+        gone = [k for k in (self._versions[table] if keys is None else keys) if k not in found]
+        with self._write_lock, self._data_lock:
+            data = self._table_data(table)
+            for key, row in list(found.items()) + [(k, None) for k in gone]:
+                with self._dirty_lock:
+                    if key in self._dirty[table]:
+                        # our own write is on its way and will merge with this one
+                        continue
+                if row is None and key not in self._versions[table]:
+                    continue
+                if row is not None and row[1] <= self._versions[table].get(key, 0):
+                    # our own write, or one we have already seen
+                    continue
+                old = data.get(key, _MISSING)
+                base = self._fingerprints[table].get(key)
+                if base is None and old is not _MISSING:
+                    base = _fingerprint(*_dump_row(old))
+                if row is None:
+                    data.pop(key, None)
+                    self._fingerprints[table].pop(key, None)
+                    self._versions[table].pop(key, None)
+                else:
+                    data[key] = json.loads(row[0])
+                    self._fingerprints[table][key] = _fingerprint(*_dump_row(data[key]))
+                    self._versions[table][key] = row[1]
+                with self._dirty_lock:
+                    self._refresh[table].setdefault(key, base)
+                self.stats["reloaded"] += 1
+
+    def _dirty_rows(self) -> Tuple[list, Dict, Dict]:
+        """Takes the changed rows as ``(query, params, ...)`` tuples and clears the dirty marks."""
+        rows = []
+        written = {}
+        with self._dirty_lock:
+            dirty, self._dirty = self._dirty, {table: set() for table in self._dirty}
+        for table, data in (("user_data", self._user_data), ("chat_data", self._chat_data)):
+            for key in dirty[table]:
+                rows.append(self._row_write(table, key, data[key], written))
+        for key in dirty["bot_data"]:
+            value = self._bot_data.get(key, _MISSING)
+            if value is _MISSING:
+                rows.append((DELETE["bot_data"], {"key": key}))
+                written[("bot_data", key)] = None
+            else:
+                rows.append(self._row_write("bot_data", key, value, written))
+        for name, key in dirty["conversations"]:
+            state = self._conversations[name].get(key)
+            params = {"name": name, "key": json.dumps(key)}
+            if state is None:
+                rows.append((DELETE["conversations"], params))
+            else:
+                params["data"] = json.dumps(state)
+                rows.append((UPSERT["conversations"], params))
+        return [row for row in rows if row is not None], dirty, written
+
+    def _update_database(self, timeout: float = -1) -> None:
+        if not self._write_lock.acquire(timeout=timeout):
+            self.logger.warning("Gave up waiting for the database write in progress.")
+            return
+        try:
+            rows, dirty, written = self._dirty_rows()
+            if not rows:
+                return
+            self.logger.debug("Updating %d rows in the database...", len(rows))
+            try:
+                for qry, params, *versioned in rows:
+                    result = self._session.execute(text(qry), params)
+                    if versioned and not result.rowcount:
+                        self._merge_row(*versioned, written)
+                if self._notify and written:
+                    self._session.execute(
+                        text("SELECT pg_notify(:channel, :payload)"),
+                        {"channel": CHANNEL, "payload": self._notify_payload(written)},
+                    )
+                self._session.commit()
+                self.stats["writes"] += 1
+                self.stats["rows"] += len(rows)
+                self.stats["bytes"] += _query_bytes(rows)
+                for (table, key), row in written.items():
+                    if row is None:
+                        self._fingerprints[table].pop(key, None)
+                        self._versions[table].pop(key, None)
+                    else:
+                        self._fingerprints[table][key], self._versions[table][key] = row
+            except Exception as excp:  # pylint: disable=W0703
+                self._session.rollback()
+                self.stats["failed"] += 1
+                # keep the rows dirty so the next write retries them
+                for table, keys in dirty.items():
+                    self._mark_dirty(table, *keys)
+                self.logger.error(
+                    "Failed to save data in the database.\nLogging exception: ",
+                    exc_info=excp,
+                )
+            finally:
+                self._session.close()
+        finally:
+            self._write_lock.release()
 
     def update_conversation(
         self, name: str, key: Tuple[int, ...], new_state: Optional[object]
@@ -160,9 +659,11 @@ class PostgresPersistence(DictPersistence):
             key (:obj:`tuple`): The key the state is changed for.
             new_state (:obj:`tuple` | :obj:`any`): The new state for the given key.
         """
+        if (self._conversations or {}).get(name, {}).get(key) == new_state:
+            self.stats["unchanged"] += 1
+            return
         super().update_conversation(name, key, new_state)
-        if not self.on_flush:
-            self._update_database()
+        self._changed_rows("conversations", (name, key))
 
     def update_user_data(self, user_id: int, data: Dict) -> None:
         """Will update the user_data (if changed).
@@ -170,9 +671,14 @@ class PostgresPersistence(DictPersistence):
             user_id (:obj:`int`): The user the data might have been changed for.
             data (:obj:`dict`): The :attr:`telegram.ext.Dispatcher.user_data` ``[user_id]``.
         """
-        super().update_user_data(user_id, data)
-        if not self.on_flush:
-            self._update_database()
+        with self._data_lock:
+            data = self._catch_up("user_data", user_id, data)
+            if self._user_data is not None and self._user_data.get(user_id) == data:
+                self.stats["unchanged"] += 1
+                return
+            self._keep_base("user_data", user_id)
+            super().update_user_data(user_id, data)
+        self._changed_rows("user_data", user_id)
 
     def update_chat_data(self, chat_id: int, data: Dict) -> None:
         """Will update the chat_data (if changed).
@@ -180,18 +686,78 @@ class PostgresPersistence(DictPersistence):
             chat_id (:obj:`int`): The chat the data might have been changed for.
             data (:obj:`dict`): The :attr:`telegram.ext.Dispatcher.chat_data` ``[chat_id]``.
         """
-        super().update_chat_data(chat_id, data)
-        if not self.on_flush:
-            self._update_database()
+        with self._data_lock:
+            data = self._catch_up("chat_data", chat_id, data)
+            if self._chat_data is not None and self._chat_data.get(chat_id) == data:
+                self.stats["unchanged"] += 1
+                return
+            self._keep_base("chat_data", chat_id)
+            super().update_chat_data(chat_id, data)
+        self._changed_rows("chat_data", chat_id)
 
     def update_bot_data(self, data: Dict) -> None:
         """Will update the bot_data (if changed).
         Args:
             data (:obj:`dict`): The :attr:`telegram.ext.Dispatcher.bot_data`.
         """
-        super().update_bot_data(data)
-        if not self.on_flush:
-            self._update_database()
+        with self._data_lock:
+            old = self._bot_data or {}
+            with self._dirty_lock:
+                pending = list(self._refresh["bot_data"])
+            if pending:
+                data = dict(data)
+                for key in pending:
+                    value = self._catch_up("bot_data", key, data.get(key, _MISSING))
+                    if value is _MISSING:
+                        data.pop(key, None)
+                    else:
+                        data[key] = value
+            changed = {k for k in old.keys() | data.keys() if old.get(k, _MISSING) != data.get(k, _MISSING)}
+            if not changed:
+                self.stats["unchanged"] += 1
+                return
+            super().update_bot_data(data)
+        self._changed_rows("bot_data", *changed)
+
+    def refresh_user_data(self, user_id: int, user_data: Dict) -> None:
+        """Hands user_data changed by another process to the dispatcher.
+        Args:
+            user_id (:obj:`int`): The user ID this user_data is associated with.
+            user_data (:obj:`dict`): The :attr:`telegram.ext.Dispatcher.user_data` ``[user_id]``.
+        """
+        with self._data_lock:
+            with self._dirty_lock:
+                if self._refresh["user_data"].pop(user_id, _MISSING) is _MISSING:
+                    return
+            user_data.clear()
+            user_data.update(deepcopy(self._user_data[user_id]))
+
+    def refresh_chat_data(self, chat_id: int, chat_data: Dict) -> None:
+        """Hands chat_data changed by another process to the dispatcher.
+        Args:
+            chat_id (:obj:`int`): The chat ID this chat_data is associated with.
+            chat_data (:obj:`dict`): The :attr:`telegram.ext.Dispatcher.chat_data` ``[chat_id]``.
+        """
+        with self._data_lock:
+            with self._dirty_lock:
+                if self._refresh["chat_data"].pop(chat_id, _MISSING) is _MISSING:
+                    return
+            chat_data.clear()
+            chat_data.update(deepcopy(self._chat_data[chat_id]))
+
+    def refresh_bot_data(self, bot_data: Dict) -> None:
+        """Hands bot_data keys changed by another process to the dispatcher.
+        Args:
+            bot_data (:obj:`dict`): The :attr:`telegram.ext.Dispatcher.bot_data`.
+        """
+        with self._data_lock:
+            with self._dirty_lock:
+                keys, self._refresh["bot_data"] = self._refresh["bot_data"], {}
+            for key in keys:
+                if key in self._bot_data:
+                    bot_data[key] = deepcopy(self._bot_data[key])
+                else:
+                    bot_data.pop(key, None)
 
     def flush(self) -> None:
         """Will be called by :class:`telegram.ext.Updater` upon receiving a stop signal. Gives the
@@ -0,0 +1,432 @@
+'''
+Drawing of the schedule images.
+
+The layout_* functions turn event records into a layout: a plain dict that
+describes the figure, the axes labels and every booking block. A backend then
+draws the layout: 'matplotlib' is the original renderer, 'pillow' draws the
+same picture directly with Pillow and is much cheaper.
+
+The pillow backend keeps the static frame of each image and one tile per
+row band (a room on a day) cached by content, so after a booking change only
+that band is drawn again and the image is composited from the rest.
+
+An output profile picks the file format, resolution and compression of the
+finished image, see PROFILES.
+'''
+import io
+import importlib.util
+import os
+import re
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache
+
+colors=['pink', 'lightgreen', 'lightblue', 'wheat', 'salmon', 'thistle', 'yellowgreen', 'azure', 'khaki', 'maroon']
+tz = timezone(timedelta(hours=8))
+ROOMS = ['L1 Ops Hub', 'L1 Mercury\nPlanning Room', 'L2 Venus\nPlanning Room', 'L3 Terra\nPlanning Room', 'Fortitude', 'Spark', 'Steadfast', 'Gearbox', 'Forward Laager', 'TRACKED VEHICLE\nMOVEMENT']
+WEEKDAYS = ['Monday','Tuesday','Wednesday','Thursday','Friday']
+XMIN, XMAX = 7.5, 18.5     # visible hours
+DPI = 150
+BACKENDS = ('matplotlib', 'pillow')
+
+# OUTPUT PROFILES
+# 'tight' crops the matplotlib figure to its contents, which costs an extra layout pass;
+# without it the margins are fixed. compress_level is zlib's 0-9, quality is 0-100
+PROFILES = {
+    'png': {'format': 'png', 'dpi': DPI, 'tight': True, 'compress_level': 6},     # the original output
+    'png-fast': {'format': 'png', 'dpi': DPI, 'tight': False, 'compress_level': 1},
+    'jpeg': {'format': 'jpeg', 'dpi': 120, 'tight': False, 'quality': 85},
+    'webp': {'format': 'webp', 'dpi': 120, 'tight': False, 'quality': 80},
+    'mobile': {'format': 'jpeg', 'dpi': 100, 'tight': False, 'quality': 75},
+}
+
+# LAYOUTS
+# a block is (x0, x1, y, height, color, texts) and a text is (x, y, string, va, ha, fontsize),
+# all in data coordinates (x in hours, y in rows). Both are tuples so the pillow backend
+# can key its tiles on them
+
+def _hours(t: datetime) -> float:
+    return t.hour+t.minute/60
+
+def _new_layout(figsize: tuple, title: str, rows: int, yticks: list, invert: bool) -> dict:
+    return {
+        'figsize': figsize,
+        'title': title,
+        'rows': rows,
+        'yticks': tuple((y+.5, label) for y, label in enumerate(yticks)),
+        'invert': invert,
+        'hlines': list(range(1, rows)),
+        'blocks': [],
+        'legend': None,
+    }
+
+def layout_day(day: datetime, event_list: list) -> dict:
+    layout = _new_layout((10, 8), day.strftime('%d/%m/%Y'), 10, ROOMS, invert=False)
+    for e in event_list:
+        room=e.room-1
+        start_t = e.start.astimezone(tz)
+        end_t = e.end.astimezone(tz)
+        start, end = _hours(start_t), _hours(end_t)
+        if(end<7 or start>18):
+            continue
+        layout['blocks'].append((start, end, room, 1, colors[room], (
+            ((start+end)/2, room+0.5, e.summary, 'center', 'center', 5),            # name of booking
+            (start+0.01, room+0.95, start_t.strftime('%H:%M'), 'top', 'left', 4),      # beginning time
+            (end-0.01, room+0.05, end_t.strftime('%H:%M'), 'bottom', 'right', 4),      # end time
+        )))
+    return layout
+
+def layout_week(facility: int, event_list: list) -> dict:
+    layout = _new_layout((10, 4), ROOMS[facility].replace('\n',' '), 5, WEEKDAYS, invert=True)
+    for e in event_list:
+        start_t = e.start.astimezone(tz)
+        end_t = e.end.astimezone(tz)
+        day = start_t.date().weekday()
+        start, end = _hours(start_t), _hours(end_t)
+        if(end<7 or start>18 or day>4):
+            continue
+        layout['blocks'].append((start, end, day, 1, colors[day-1], (
+            ((start+end)/2, day+0.5, e.summary, 'center', 'center', 5),
+            (start+0.02, day+0.05, start_t.strftime('%H:%M'), 'top', 'left', 4),
+            (end-0.02, day+0.95, end_t.strftime('%H:%M'), 'bottom', 'right', 4),
+        )))
+    return layout
+
+def layout_all(monday: datetime, event_list: list) -> dict:
+    layout = _new_layout((12, 14), f'''All bookings, week of {monday.strftime('%d/%m/%Y')}''', 5, WEEKDAYS, invert=True)
+    layout['legend'] = [(colors[i], ROOMS[i]) for i in range(len(ROOMS))]
+    for e in event_list:
+        room=e.room-1
+        start_t = e.start.astimezone(tz)
+        end_t = e.end.astimezone(tz)
+        day = start_t.date().weekday()
+        start, end = _hours(start_t), _hours(end_t)
+        if(end<7 or start>18 or day>4):
+            continue
+        y = day+((room)/10)
+        layout['blocks'].append((start, end, y, 0.1, colors[room], (
+            ((start+end)/2, y+0.05, e.summary, 'center', 'center', 5),
+            (start+0.01, y+0.01, start_t.strftime('%H:%M'), 'top', 'left', 4),
+            (end-0.01, y+0.09, end_t.strftime('%H:%M'), 'bottom', 'right', 4),
+        )))
+    return layout
+
+def render(layout: dict, backend: str = 'matplotlib', profile='png') -> io.BytesIO:
+    '''Draws layout with backend and encodes it as profile, a PROFILES name or a dict like them.'''
+    if isinstance(profile, str):
+        if profile not in PROFILES:
+            raise ValueError(f'unknown output profile {profile!r}, expected one of {tuple(PROFILES)}')
+        profile = PROFILES[profile]
+    if backend == 'matplotlib':
+        return render_matplotlib(layout, profile)
+    if backend == 'pillow':
+        return render_pillow(layout, profile)
+    raise ValueError(f'unknown render backend {backend!r}, expected one of {BACKENDS}')
+
+def render_bytes(layout: dict, backend: str = 'matplotlib', profile='png') -> bytes:
+    '''render() as plain bytes, for running in a worker process.'''
+    return render(layout, backend, profile).getvalue()
+
+def _encode(img, profile: dict) -> io.BytesIO:
+    '''Saves a PIL image in the profile's format.'''
+    buf = io.BytesIO()
+    fmt = profile['format']
+    if fmt == 'png':
+        img.save(buf, format='png', compress_level=profile.get('compress_level', 6))
+    elif fmt == 'jpeg':
+        img.convert('RGB').save(buf, format='jpeg', quality=profile.get('quality', 85))
+    elif fmt == 'webp':
+        img.save(buf, format='webp', quality=profile.get('quality', 80), method=profile.get('method', 4))
+    else:
+        raise ValueError(f'unsupported image format {fmt!r}')
+    buf.seek(0)
+    return buf
+
+# MATPLOTLIB BACKEND
+
+# average width of a DejaVu Sans character, in font sizes
+CHAR_WIDTH = 0.6
+# the start and end times drawn in the corners of a block
+TIME_LABEL = re.compile(r'\d\d:\d\d')
+
+def _fit_label(s: str, fontsize: float, width: float) -> str:
+    '''s shortened to fit width points, or '' when not even a few characters would.'''
+    fits = int(width/(fontsize*CHAR_WIDTH))
+    if len(s) <= fits:
+        return s
+    if fits < 4 or TIME_LABEL.fullmatch(s):
+        # times are all or nothing
+        return ''
+    return s[:fits-1].rstrip()+'…'
+
+def _visible_texts(blocks: list, hour_pt: float) -> list:
+    '''The texts of blocks worth drawing, shortened to the visible part of their block.
+
+    Labels that would run outside the visible hours or over the label of an
+    overlapping booking are left out. hour_pt is the width of an hour in points.
+    '''
+    visible = []
+    placed = {}     # (y, va) -> right edge of the last label drawn on that line, in points
+    for start, end, _, _, _, texts in sorted(blocks, key=lambda b: b[0]):
+        width = (min(end, XMAX)-max(start, XMIN))*hour_pt
+        for x, ty, s, va, ha, size in texts:
+            if ha == 'center' and (start < XMIN or end > XMAX):
+                # centred on what can be seen of the block
+                x = (max(start, XMIN)+min(end, XMAX))/2
+            s = _fit_label(s, size, width)
+            if not s:
+                continue
+            w = len(s)*size*CHAR_WIDTH
+            left = x*hour_pt - {'left': 0, 'center': w/2, 'right': w}[ha]
+            if left < XMIN*hour_pt or left+w > XMAX*hour_pt:
+                # would print over the axes into the margin
+                continue
+            if left < placed.get((ty, va), float('-inf')):
+                # would print over the label of an overlapping booking
+                continue
+            placed[(ty, va)] = left + w
+            visible.append((x, ty, s, va, ha, size))
+    return visible
+
+def render_matplotlib(layout: dict, profile: dict = PROFILES['png']) -> io.BytesIO:
+    # object oriented api only: pyplot keeps global figure state, which is
+    # shared between threads and holds on to every figure until it is closed
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from matplotlib.collections import PolyCollection
+    from matplotlib.patches import Patch
+    import numpy as np
+
+    fig = Figure(figsize=layout['figsize'])
+    canvas = FigureCanvasAgg(fig)
+    ax = fig.add_subplot()
+    if not profile['tight']:
+        # fixed margins, in inches, wide enough for the labels, title and legend
+        w, h = layout['figsize']
+        fig.subplots_adjust(left=1.3/w, right=1-0.25/w, bottom=0.45/h, top=1-(1.75 if layout['legend'] else 0.45)/h)
+
+    ax.tick_params(axis='both', which='major', labelsize=8)
+    ax.tick_params(axis='both', which='minor', length=0)
+    blocks = layout['blocks']
+    if blocks:
+        # every event in one collection, built straight from arrays
+        start, end, y, height = np.array([b[:4] for b in blocks], dtype=float).T
+        verts = np.stack([
+            np.column_stack([start, y]), np.column_stack([end, y]),
+            np.column_stack([end, y+height]), np.column_stack([start, y+height]),
+        ], axis=1)
+        ax.add_collection(PolyCollection(verts, facecolors=[b[4] for b in blocks], edgecolors='k', linewidths=0.7), autolim=False)
+    # width of an hour in points, for leaving out labels that don't fit their block
+    hour_pt = layout['figsize'][0]*72*(fig.subplotpars.right-fig.subplotpars.left)/(XMAX-XMIN)
+    for x, ty, s, va, ha, size in _visible_texts(blocks, hour_pt):
+        ax.text(x, ty, s, va=va, ha=ha, fontsize=size)
+
+    ax.set_xticks(np.arange(7,19), [f'{n:02}:00' for n in np.arange(7,19)])
+    ax.set_xticks(np.arange(7,19,0.25), minor=True)
+    ax.set_yticks([y for y, _ in layout['yticks']], [label for _, label in layout['yticks']])
+    ax.grid(axis='x', alpha=0.5, which='minor')
+    ax.grid(axis='x', alpha=0.5, which='major', lw=1.2)
+    ax.set_ylim(0, layout['rows'])
+    ax.set_xlim(XMIN, XMAX)
+    if layout['invert']:
+        ax.invert_yaxis()
+
+    # full width like axhline, as a single collection
+    ax.hlines(layout['hlines'], 0, 1, transform=ax.get_yaxis_transform(), color='k', lw=1)
+    if layout['legend']:
+        legend_handles = [Patch(color=color, label=label) for color, label in layout['legend']]
+        ax.legend(handles=legend_handles,
+            prop={'size': 5},
+            bbox_to_anchor=(0., 1.02, 1., .102),
+            loc='upper left',
+            ncol=5, mode="expand",
+            borderaxespad=0.
+        )
+    ax.set_title(layout['title'])
+    if profile['tight']:
+        buf = io.BytesIO()
+        fig.savefig(buf, format='png', dpi=profile['dpi'], bbox_inches='tight', pil_kwargs={'compress_level': profile.get('compress_level', 6)})
+        if profile['format'] != 'png':
+            from PIL import Image
+            buf = _encode(Image.open(buf), profile)
+    else:
+        # a single draw straight into the agg buffer, encoded by Pillow
+        from PIL import Image
+        fig.set_dpi(profile['dpi'])
+        canvas.draw()
+        buf = _encode(Image.fromarray(np.asarray(canvas.buffer_rgba())).convert('RGB'), profile)
+    # drop the artists and the agg renderer now instead of waiting for the gc
+    fig.clear()
+    del fig, canvas
+    buf.seek(0)
+    return buf
+
+# PILLOW BACKEND
+
+def _pt(points: float) -> int:
+    '''Font points to pixels at DPI.'''
+    return max(1, round(points*DPI/72))
+
+@lru_cache(maxsize=None)
+def _font(points: float):
+    from PIL import ImageFont
+    size = _pt(points)
+    candidates = ['DejaVuSans.ttf']
+    # matplotlib ships DejaVu Sans, use it without importing matplotlib
+    spec = importlib.util.find_spec('matplotlib')
+    if spec is not None and spec.submodule_search_locations:
+        candidates.append(os.path.join(spec.submodule_search_locations[0], 'mpl-data', 'fonts', 'ttf', 'DejaVuSans.ttf'))
+    for candidate in candidates:
+        try:
+            return ImageFont.truetype(candidate, size)
+        except OSError:
+            continue
+    try:
+        return ImageFont.load_default(size=size)
+    except TypeError:   # Pillow < 10.1
+        return ImageFont.load_default()
+
+def _text(draw, x: float, y: float, s: str, va: str, ha: str, font, fill='black') -> None:
+    '''Draws s aligned on (x, y) the way matplotlib's va/ha do.'''
+    left, top, right, bottom = draw.multiline_textbbox((0, 0), s, font=font)
+    w, h = right-left, bottom-top
+    if ha == 'center':
+        x -= w/2
+    elif ha == 'right':
+        x -= w
+    if va == 'center':
+        y -= h/2
+    elif va in ('bottom', 'baseline'):
+        y -= h
+    draw.multiline_text((x-left, y-top), s, font=font, fill=fill, align=ha)
+
+def _frame_geometry(layout: dict, draw, tick_font) -> tuple:
+    '''(width, height, left, right, top, bottom, rows, invert) of the image and its plot area, in pixels.'''
+    width, height = (round(v*DPI) for v in layout['figsize'])
+    # plot area, leaving room for the labels around it
+    label_w = max(draw.multiline_textbbox((0, 0), label, font=tick_font)[2] for _, label in layout['yticks'])
+    left = label_w + _pt(12)
+    right = width - _pt(12)
+    top = _pt(30)
+    if layout['legend']:
+        top += _pt(32)
+    bottom = height - _pt(24)
+    return (width, height, left, right, top, bottom, layout['rows'], layout['invert'])
+
+def _px(geometry: tuple, x: float) -> float:
+    left, right = geometry[2], geometry[3]
+    return left + (x-XMIN)/(XMAX-XMIN)*(right-left)
+
+def _py(geometry: tuple, y: float) -> float:
+    top, bottom, rows, invert = geometry[4:]
+    if invert:
+        return top + y/rows*(bottom-top)
+    return bottom - y/rows*(bottom-top)
+
+def _frame_key(layout: dict) -> tuple:
+    legend = tuple(layout['legend']) if layout['legend'] else None
+    return (layout['figsize'], layout['title'], layout['rows'], tuple(layout['yticks']), layout['invert'], legend)
+
+@lru_cache(maxsize=32)
+def _frame(key: tuple) -> tuple:
+    '''The static part of an image (grid, axes, ticks, legend and title) and its geometry.'''
+    from PIL import Image, ImageDraw
+    figsize, title, rows, yticks, invert, legend = key
+    layout = {'figsize': figsize, 'rows': rows, 'yticks': yticks, 'invert': invert, 'legend': legend}
+    tick_font, title_font = _font(8), _font(12)
+    width, height = (round(v*DPI) for v in figsize)
+    img = Image.new('RGB', (width, height), 'white')
+    draw = ImageDraw.Draw(img)
+    g = _frame_geometry(layout, draw, tick_font)
+    left, right, top, bottom = g[2:6]
+
+    # grid: quarter hours light, hours heavier
+    for i in range(7*4, 19*4):
+        x = _px(g, i/4)
+        if x <= left or x >= right:
+            continue
+        major = i % 4 == 0
+        draw.line([(x, top), (x, bottom)], fill='#d8d8d8' if not major else '#c4c4c4', width=_pt(1.2) if major else _pt(0.8))
+
+    tick = _pt(3.5)
+    for hour in range(8, 19):
+        x = _px(g, hour)
+        draw.line([(x, bottom), (x, bottom+tick)], fill='black', width=_pt(0.8))
+        _text(draw, x, bottom+tick+_pt(2), f'{hour:02}:00', 'top', 'center', tick_font)
+    for y, label in yticks:
+        draw.line([(left-tick, _py(g, y)), (left, _py(g, y))], fill='black', width=_pt(0.8))
+        _text(draw, left-tick-_pt(2), _py(g, y), label, 'center', 'right', tick_font)
+
+    title_y = top - _pt(6)
+    if legend:
+        legend_font = _font(5)
+        cols = 5
+        col_w = (right-left)/cols
+        box = _pt(8)
+        for i, (color, label) in enumerate(legend):
+            lx = left + (i % cols)*col_w + _pt(4)
+            ly = top - _pt(30) + (i//cols)*_pt(14)
+            draw.rectangle([lx, ly, lx+box*2, ly+box], fill=color)
+            _text(draw, lx+box*2+_pt(4), ly+box/2, label, 'center', 'left', legend_font)
+        title_y = top - _pt(36)
+    _text(draw, (left+right)/2, title_y, title, 'bottom', 'center', title_font)
+    return img, g
+
+@lru_cache(maxsize=256)
+def _tile(geometry: tuple, y: float, h: float, blocks: tuple) -> tuple:
+    '''The blocks of one row band (one room on one day) drawn on a transparent strip, cropped to what was drawn.
+
+    Returns (image, (x, y)) to paste at, or None when nothing is visible. Tiles
+    are keyed by their contents, so a booking change only redraws its own band.
+    '''
+    from PIL import Image, ImageDraw
+    width = geometry[0]
+    y0, y1 = sorted((_py(geometry, y), _py(geometry, y+h)))
+    # room for text running over the edge of the band
+    pad = _pt(8)
+    oy = int(y0) - pad
+    img = Image.new('RGBA', (width, int(y1-y0) + 2*pad + 2), (0, 0, 0, 0))
+    draw = ImageDraw.Draw(img)
+    for start, end, by, bh, color, _ in blocks:
+        if end <= XMIN or start >= XMAX:
+            continue
+        x0, x1 = sorted((_px(geometry, max(start, XMIN)), _px(geometry, min(end, XMAX))))
+        b0, b1 = sorted((_py(geometry, by), _py(geometry, by+bh)))
+        draw.rectangle([x0, b0-oy, x1, b1-oy], fill=color, outline='black', width=_pt(0.7))
+    # the same labels as the matplotlib backend, with the hour width converted from pixels
+    hour_pt = (geometry[3]-geometry[2])/(XMAX-XMIN)*72/DPI
+    for tx, ty, s, va, ha, size in _visible_texts(blocks, hour_pt):
+        _text(draw, _px(geometry, tx), _py(geometry, ty)-oy, s, va, ha, _font(size))
+    bbox = img.getbbox()
+    if bbox is None:
+        return None
+    return img.crop(bbox), (bbox[0], oy+bbox[1])
+
+def render_pillow(layout: dict, profile: dict = PROFILES['png']) -> io.BytesIO:
+    '''Composites cached row-band tiles onto a cached static frame.'''
+    from PIL import Image, ImageDraw
+
+    frame, g = _frame(_frame_key(layout))
+    img = frame.copy()
+    bands = {}
+    for block in layout['blocks']:
+        bands.setdefault((block[2], block[3]), []).append(block)
+    for (y, h), blocks in bands.items():
+        tile = _tile(g, y, h, tuple(blocks))
+        if tile is not None:
+            img.paste(tile[0], tile[1], tile[0])
+
+    # row dividers and the axes frame go over the blocks
+    draw = ImageDraw.Draw(img)
+    left, right, top, bottom = g[2:6]
+    for y in layout['hlines']:
+        draw.line([(left, _py(g, y)), (right, _py(g, y))], fill='black', width=_pt(1))
+    draw.rectangle([left, top, right, bottom], outline='black', width=_pt(0.8))
+
+    # everything is laid out at DPI, other resolutions are scaled from it
+    if profile['dpi'] != DPI:
+        scale = profile['dpi']/DPI
+        img = img.resize((round(img.width*scale), round(img.height*scale)), Image.BILINEAR, reducing_gap=2.0)
+    return _encode(img, profile)
+
+def tile_stats() -> dict:
+    return {'frames': _frame.cache_info()._asdict(), 'tiles': _tile.cache_info()._asdict()}
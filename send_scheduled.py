@@ -3,7 +3,6 @@ from datetime import datetime, timedelta, timezone, tzinfo
 import json
 import time
 
-import dateparser
 from msvsbot import init_testing_deploy
 import os
 from postgrespersistence import PostgresPersistence
@@ -21,12 +20,13 @@ def check_track_movement():
     calendarId = cal_ids[-1]
     daystart_dt = bd
     dayend_dt = (bd+timedelta(days=1))
-    event_list = get_event_list([calendarId], daystart_dt, dayend_dt)
+    # a one-off run, loading the mirror would cost more than the one query
+    event_list = get_event_list([calendarId], daystart_dt, dayend_dt, max_age=-1, records=True)
     if not event_list:
         return None
     for e in event_list:
-        start_t = dateparser.parse(e['start']['dateTime']).astimezone(tz).strftime('%H%M')
-        end_t = dateparser.parse(e['end']['dateTime']).astimezone(tz).strftime('%H%M')
+        start_t = e.start.astimezone(tz).strftime('%H%M')
+        end_t = e.end.astimezone(tz).strftime('%H%M')
         booklist+=f'[{start_t}-{end_t}]\n'
     return booklist
 
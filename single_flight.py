@@ -0,0 +1,59 @@
+'''
+Single-flight deduplication of concurrent identical calls.
+
+The first caller of a key runs the function. Everyone who asks for the same
+key while it is still running waits for that run and gets its result (or
+its exception) instead of starting their own. Nothing is kept once the call
+finishes, so this is not a cache.
+'''
+import threading
+
+
+class _Call:
+    __slots__ = ('done', 'result', 'exception')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.exception = None
+
+
+class SingleFlight:
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+        self.stats = {'calls': 0, 'runs': 0, 'coalesced': 0}
+
+    def do(self, key, fn, *args):
+        '''fn(*args), shared with any identical call (same key) already in flight.'''
+        with self._lock:
+            self.stats['calls'] += 1
+            call = self._calls.get(key)
+            if call is not None:
+                self.stats['coalesced'] += 1
+                leader = False
+            else:
+                call = self._calls[key] = _Call()
+                self.stats['runs'] += 1
+                leader = True
+        if not leader:
+            call.done.wait()
+            if call.exception is not None:
+                raise call.exception
+            return call.result
+        try:
+            call.result = fn(*args)
+        except BaseException as e:
+            call.exception = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            stats = dict(self.stats)
+            stats['in_flight'] = len(self._calls)
+            return stats
@@ -0,0 +1,60 @@
+'''
+Timings of the bot's start-up.
+
+main.py marks each start-up phase as it finishes, and the profile is logged
+once the first update has been answered. process_age() counts from the
+moment the process was started, so interpreter and gunicorn start-up are
+included.
+'''
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+def process_age() -> float:
+    '''Seconds since this process was started, or None where /proc is not available.'''
+    try:
+        with open('/proc/self/stat') as f:
+            # the command name can contain spaces, the fields after it can't
+            started = int(f.read().rsplit(')', 1)[1].split()[19])
+        with open('/proc/uptime') as f:
+            uptime = float(f.read().split()[0])
+    except (OSError, IndexError, ValueError):
+        return None
+    return uptime - started/os.sysconf('SC_CLK_TCK')
+
+
+class StartupProfile:
+    def __init__(self):
+        self._t0 = time.perf_counter()
+        self._last = self._t0
+        self._age0 = process_age()
+        self.phases = []    # (name, seconds)
+        self._lock = threading.Lock()
+        self._done = False
+
+    def mark(self, name: str) -> None:
+        '''Ends the phase called name.'''
+        now = time.perf_counter()
+        self.phases.append((name, now - self._last))
+        self._last = now
+
+    def first_response(self) -> None:
+        '''Logs the profile the first time it is called.'''
+        with self._lock:
+            if self._done:
+                return
+            self._done = True
+        since_import = time.perf_counter() - self._t0
+        phases = ', '.join(f'{name} {seconds*1000:.0f} ms' for name, seconds in self.phases)
+        since_start = f', {self._age0 + since_import:.2f}s after process start' if self._age0 is not None else ''
+        logger.info(f'first update answered {since_import:.2f}s after main was imported{since_start} ({phases})')
+
+    def as_dict(self) -> dict:
+        return {
+            'process_age_at_import': self._age0,
+            'phases': dict(self.phases),
+        }
@@ -0,0 +1,87 @@
+from datetime import datetime, timedelta
+
+import pytest
+from googleapiclient.discovery import build
+
+import calendar_generator
+from event_store import EventStore
+from fake_calendar import FakeCalendarHttp
+
+tz = calendar_generator.tz
+CALENDARS = ['room1', 'room2', 'room3']
+
+
+@pytest.fixture
+def fake(monkeypatch):
+    http = FakeCalendarHttp(page_size=2)
+    start = datetime.now(tz).replace(hour=8, minute=0, second=0, microsecond=0)
+    # 5 events in room1 and 3 in room2 need 3 and 2 pages, room3 is empty
+    for calendarId, count in (('room1', 5), ('room2', 3)):
+        for i in range(count):
+            http.add_event(calendarId, f'{calendarId} {i}', start + timedelta(hours=i), start + timedelta(hours=i, minutes=30))
+    service = build('calendar', 'v3', http=http, static_discovery=True, cache_discovery=False, developerKey='x')
+    monkeypatch.setattr(calendar_generator, 'get_calendar_service', lambda: service)
+    monkeypatch.setattr(calendar_generator, 'event_store', EventStore())
+    monkeypatch.setattr(calendar_generator, 'CALENDAR_FETCH_MODE', 'batch')
+    return http, start
+
+
+def day_of(start):
+    return start.replace(hour=0), start.replace(hour=0) + timedelta(days=1)
+
+
+def summaries(events):
+    return [e['summary'] for e in events]
+
+
+def test_batch_follows_pages_with_one_request_per_page_depth(fake):
+    http, start = fake
+    events = calendar_generator.get_event_list_batch(CALENDARS, *day_of(start))
+    assert summaries(events) == [f'room1 {i}' for i in range(5)] + [f'room2 {i}' for i in range(3)]
+    assert [e['room'] for e in events] == [1]*5 + [2]*3
+    # room1 is three pages deep, and every depth is one batch
+    assert http.stats == {'requests': 3, 'batches': 3, 'batched_calls': 3 + 2 + 1}
+
+
+def test_batch_keeps_the_other_calendars_when_one_fails(fake):
+    http, start = fake
+    http.failing.add('room2')
+    errors = {}
+    events = calendar_generator.get_event_list_batch(CALENDARS, *day_of(start), errors)
+    assert summaries(events) == [f'room1 {i}' for i in range(5)]
+    assert list(errors) == [2]
+    assert errors[2].resp.status == 500
+    with pytest.raises(Exception):
+        calendar_generator.get_event_list_batch(CALENDARS, *day_of(start))
+
+
+def test_mirror_sync_is_batched_and_then_incremental(fake):
+    http, start = fake
+    first, last = day_of(start)
+    events = calendar_generator.get_event_list(CALENDARS, first, last, max_age=0)
+    assert summaries(events) == [f'room1 {i}' for i in range(5)] + [f'room2 {i}' for i in range(3)]
+    assert http.stats['requests'] == 3
+    assert calendar_generator.event_store.get_stats()['full_syncs'] == 3
+
+    http.add_event('room3', 'room3 0', start, start + timedelta(hours=1))
+    events = calendar_generator.get_event_list(CALENDARS, first, last, max_age=0)
+    assert summaries(events)[-1] == 'room3 0'
+    # the three syncToken syncs go out together
+    assert http.stats['requests'] == 4
+    assert http.stats['batched_calls'] == 6 + 3
+    assert calendar_generator.event_store.get_stats()['incremental_syncs'] == 3
+
+
+def test_mirror_sync_reports_a_failing_calendar_and_retries_it(fake):
+    http, start = fake
+    http.failing.add('room1')
+    errors = {}
+    events = calendar_generator.get_event_list(CALENDARS, *day_of(start), errors, max_age=60)
+    assert summaries(events) == [f'room2 {i}' for i in range(3)]
+    assert list(errors) == [1]
+
+    http.failing.clear()
+    events = calendar_generator.get_event_list(CALENDARS, *day_of(start), max_age=60)
+    assert summaries(events) == [f'room1 {i}' for i in range(5)] + [f'room2 {i}' for i in range(3)]
+    # only room1 was left to sync, in three pages
+    assert calendar_generator.event_store.get_stats()['full_syncs'] == 3
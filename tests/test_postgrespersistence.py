@@ -0,0 +1,85 @@
+from threading import Thread
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import scoped_session, sessionmaker
+
+from postgrespersistence import PostgresPersistence
+
+
+def make_persistence(path):
+    engine = create_engine(f"sqlite:///{path}", connect_args={"check_same_thread": False})
+    return PostgresPersistence(session=scoped_session(sessionmaker(bind=engine)))
+
+
+def stored_bot_data(path):
+    return make_persistence(path).get_bot_data()
+
+
+def test_concurrent_booking_request_appends_are_both_kept(tmp_path):
+    path = tmp_path / "persistence.db"
+    make_persistence(path).update_bot_data({"booking_requests": [["a", 1]]})
+    first, second = make_persistence(path), make_persistence(path)
+    first_data, second_data = first.get_bot_data(), second.get_bot_data()
+
+    first_data["booking_requests"].append(["b", 2])
+    first.update_bot_data(first_data)
+    second_data["booking_requests"].append(["c", 3])
+    second.update_bot_data(second_data)
+
+    assert stored_bot_data(path)["booking_requests"] == [["a", 1], ["b", 2], ["c", 3]]
+    second.refresh_bot_data(second_data)
+    assert second_data["booking_requests"] == [["a", 1], ["b", 2], ["c", 3]]
+
+
+def test_stale_writer_does_not_bring_back_a_removed_request(tmp_path):
+    path = tmp_path / "persistence.db"
+    make_persistence(path).update_bot_data({"booking_requests": [["a", 1], ["b", 2]]})
+    first, second = make_persistence(path), make_persistence(path)
+    first_data, second_data = first.get_bot_data(), second.get_bot_data()
+
+    first_data["booking_requests"].pop(0)
+    first.update_bot_data(first_data)
+    second_data["booking_requests"].append(["c", 3])
+    second.update_bot_data(second_data)
+
+    assert stored_bot_data(path)["booking_requests"] == [["b", 2], ["c", 3]]
+
+
+def test_lazily_fingerprinted_user_row_keeps_the_other_writers_keys(tmp_path):
+    path = tmp_path / "persistence.db"
+    make_persistence(path).update_user_data(7, {"a": 1, "b": 1})
+    first, second = make_persistence(path), make_persistence(path)
+    first_data, second_data = first.get_user_data()[7], second.get_user_data()[7]
+
+    first_data["a"] = 2
+    first.update_user_data(7, first_data)
+    second_data["b"] = 2
+    second.update_user_data(7, second_data)
+
+    assert make_persistence(path).get_user_data()[7] == {"a": 2, "b": 2}
+
+
+def test_update_during_a_merge_is_not_overwritten_by_it(tmp_path):
+    path = tmp_path / "persistence.db"
+    make_persistence(path).update_user_data(7, {"a": 1})
+    first, second = make_persistence(path), make_persistence(path)
+    first_data, second_data = first.get_user_data()[7], second.get_user_data()[7]
+    first_data["b"] = 2
+    first.update_user_data(7, first_data)
+
+    merge = second._merge
+    dispatcher = Thread(target=second.update_user_data, args=(7, {"a": 1, "c": 3, "d": 4}))
+
+    def merge_while_updated(base, ours, theirs):
+        # the dispatcher hands over a newer row while the writer is merging the older one
+        if dispatcher.ident is None:
+            dispatcher.start()
+            dispatcher.join(0.2)
+        return merge(base, ours, theirs)
+
+    second._merge = merge_while_updated
+    second_data["c"] = 3
+    second.update_user_data(7, second_data)
+    dispatcher.join()
+
+    assert make_persistence(path).get_user_data()[7] == {"a": 1, "b": 2, "c": 3, "d": 4}
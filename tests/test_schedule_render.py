@@ -0,0 +1,44 @@
+import pytest
+
+from benchmark import STRESS_RSS_TOLERANCE_MB, _stress_run
+from schedule_render import CHAR_WIDTH, XMAX, XMIN, _fit_label, _visible_texts
+
+
+def width_of(s, fontsize):
+    return len(s)*fontsize*CHAR_WIDTH
+
+
+def test_summary_with_a_colon_is_kept_when_it_fits():
+    assert _fit_label('CCA: Band practice', 5, width_of('CCA: Band practice', 5)) == 'CCA: Band practice'
+
+
+def test_summary_with_a_colon_is_shortened_when_it_does_not_fit():
+    assert _fit_label('Meeting: 3pm with the team', 5, width_of('Meeting: 3p', 5)) == 'Meeting: 3…'
+
+
+def test_times_are_left_out_rather_than_shortened():
+    assert _fit_label('09:30', 4, width_of('09:3', 4)) == ''
+
+
+def test_labels_stay_inside_the_visible_hours():
+    # 06:00-09:00, starting before the visible hours
+    block = (6, 9, 0, 1, 'pink', (
+        (7.5, 0.5, 'Early bird', 'center', 'center', 5),
+        (6.01, 0.95, '06:00', 'top', 'left', 4),
+        (8.99, 0.05, '09:00', 'bottom', 'right', 4),
+    ))
+    hour_pt = 60
+    texts = _visible_texts([block], hour_pt)
+    assert [s for _, _, s, _, _, _ in texts] == ['Early bird', '09:00']
+    x, _, s, _, _, size = texts[0]
+    w = width_of(s, size)
+    assert XMIN*hour_pt <= x*hour_pt - w/2 and x*hour_pt + w/2 <= XMAX*hour_pt
+
+
+@pytest.mark.parametrize("backend, renders", [("matplotlib", 20), ("pillow", 100)])
+def test_concurrent_renders_are_right_and_rss_stays_flat(backend, renders):
+    # the first renders on each thread load fonts and caches, keep them out of the samples
+    _stress_run(backend, 10, threads=4)
+    samples, mismatched = _stress_run(backend, renders, threads=4)
+    assert mismatched == 0
+    assert (samples[-1] - samples[0]) / 1024 <= STRESS_RSS_TOLERANCE_MB
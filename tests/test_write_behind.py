@@ -0,0 +1,20 @@
+import threading
+
+from write_behind import WriteBehind
+
+
+def test_a_burst_of_changes_is_flushed_once():
+    flushed = threading.Event()
+    calls = []
+
+    def flush(timeout=-1):
+        calls.append(timeout)
+        flushed.set()
+
+    writer = WriteBehind(flush, 0.05, 1.0, "test writer")
+    for _ in range(10):
+        writer.changed()
+    assert flushed.wait(2)
+    # anything after the first flush would be a second, separate burst
+    assert not writer._changed.wait(0.2)
+    assert calls == [-1]
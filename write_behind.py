@@ -0,0 +1,68 @@
+'''
+Write-behind flushing for the persistence classes.
+
+Updates only mark what changed and call changed(). A background thread
+calls flush once no change has come in for delay seconds, and at most
+max_delay after the first one, so a burst of updates costs one write. What
+is still pending is flushed at exit and on SIGTERM, before the signal is
+handed on to whatever handled it before.
+'''
+import atexit
+import logging
+import os
+import signal
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class WriteBehind:
+    def __init__(self, flush, delay: float, max_delay: float, name: str):
+        '''flush(timeout=-1) writes everything pending, waiting at most timeout seconds
+        for a write already in progress.'''
+        self._flush = flush
+        self.delay = delay
+        self.max_delay = max_delay
+        self.name = name
+        self._changed = threading.Event()
+        threading.Thread(target=self._run, name=name, daemon=True).start()
+        atexit.register(flush)
+        self._flush_on_sigterm()
+
+    def changed(self) -> None:
+        self._changed.set()
+
+    def _run(self) -> None:
+        while True:
+            self._changed.wait()
+            deadline = time.monotonic() + self.max_delay
+            # keep collecting while changes come in less than delay apart
+            while True:
+                self._changed.clear()
+                timeout = min(self.delay, deadline - time.monotonic())
+                if timeout <= 0 or not self._changed.wait(timeout):
+                    break
+            try:
+                self._flush()
+            except Exception:
+                logger.exception(f'{self.name} failed to flush, retrying with the next change')
+
+    def _flush_on_sigterm(self) -> None:
+        # signal handlers can only be set from the main thread
+        if threading.current_thread() is not threading.main_thread():
+            return
+        previous = signal.getsignal(signal.SIGTERM)
+
+        def handler(signum, frame):
+            try:
+                # the main thread may be flushing already, don't wait on it forever
+                self._flush(timeout=5)
+            finally:
+                if callable(previous):
+                    previous(signum, frame)
+                elif previous == signal.SIG_DFL:
+                    signal.signal(signum, signal.SIG_DFL)
+                    os.kill(os.getpid(), signum)
+
+        signal.signal(signal.SIGTERM, handler)